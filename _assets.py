@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Tuple
+import gzip
+import hashlib
+import io
+import logging
+import mimetypes
+import re
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from _encoding import accepted_codings, etag_matches
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from fontTools.ttLib import TTFont
+except ImportError:
+    TTFont = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPES = {
+    ".otf": "font/otf",
+    ".woff2": "font/woff2",
+    ".webp": "image/webp",
+}
+
+# Binary formats that are already compressed.
+COMPRESSED = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".woff2"}
+
+# A compressed variant is only kept if it saves at least this much.
+MIN_SAVING = 0.1
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+@dataclass(slots=True)
+class Asset:
+    path: str
+    digest: str
+    media_type: str
+    # Encoded bodies by content coding, "identity" always included.
+    bodies: Dict[str, bytes]
+    # The same asset in a format browsers may not support, by media type.
+    alternatives: Dict[str, "Asset"] = field(default_factory=dict)
+
+    @property
+    def url_path(self) -> str:
+        """``path`` with the digest before the extension."""
+        stem, dot, ext = self.path.rpartition(".")
+        if not dot:
+            return f"{self.path}.{self.digest}"
+        return f"{stem}.{self.digest}.{ext}"
+
+
+class Assets:
+    """The files under ``static/``, fingerprinted and precompressed at startup.
+
+    Every file is served under a URL containing a hash of its content
+    (``asset_url`` in templates), so it can be cached for a year as
+    ``immutable``. References to other assets in CSS and JS are rewritten
+    to hashed URLs too. Each file is stored gzip and, if ``brotli`` is
+    installed, brotli compressed, and WOFF2 and WebP versions of fonts and
+    PNGs are made when ``fontTools`` and ``Pillow`` are. Responses carry a
+    strong ETag per representation and revalidation gets a 304.
+    """
+
+    def __init__(self, directory: str = "static", prefix: str = "/static"):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.size = 0
+        self._assets: Dict[str, Asset] = {}
+        # Both the plain and the hashed path of every asset.
+        self._routes: Dict[str, Tuple[Asset, bool]] = {}
+
+    def build(self) -> int:
+        missing = [
+            f"{package} ({variants})"
+            for package, module, variants in (
+                ("brotli", brotli, "brotli encoding, WOFF2 fonts"),
+                ("fonttools", TTFont, "WOFF2 fonts"),
+                ("Pillow", Image, "WebP images"),
+            )
+            if module is None
+        ]
+        if missing:
+            missing = ", ".join(missing)
+            logger.warning(f"Not building asset variants, not installed: {missing}")
+        files = sorted(p for p in self.directory.rglob("*") if p.is_file())
+        # Text files last, so the assets they refer to already have a hash.
+        files.sort(key=lambda p: p.suffix in (".css", ".js"))
+        for file in files:
+            path = file.relative_to(self.directory).as_posix()
+            data = file.read_bytes()
+            if file.suffix in (".css", ".js"):
+                data = self._rewrite(data.decode()).encode()
+            asset = self._add(path, data)
+            for suffix, alternative in self._alternatives(file, data).items():
+                alternative = self._add(
+                    Path(path).with_suffix(suffix).as_posix(), alternative
+                )
+                asset.alternatives[alternative.media_type] = alternative
+        self.size = sum(
+            len(body)
+            for asset in self._assets.values()
+            for body in asset.bodies.values()
+        )
+        return len(self._assets)
+
+    def _add(self, path: str, data: bytes) -> Asset:
+        asset = self._make(path, data)
+        self._assets[path] = asset
+        self._routes[path] = (asset, False)
+        self._routes[asset.url_path] = (asset, True)
+        return asset
+
+    def _make(self, path: str, data: bytes) -> Asset:
+        suffix = Path(path).suffix
+        media_type = (
+            MEDIA_TYPES.get(suffix)
+            or mimetypes.guess_type(path)[0]
+            or "application/octet-stream"
+        )
+        bodies = {"identity": data}
+        if suffix not in COMPRESSED:
+            encoded = {"gzip": gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                encoded["br"] = brotli.compress(data, quality=11)
+            for coding, body in encoded.items():
+                if len(body) <= len(data) * (1 - MIN_SAVING):
+                    bodies[coding] = body
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        return Asset(path, digest, media_type, bodies)
+
+    def _alternatives(self, file: Path, data: bytes) -> Dict[str, bytes]:
+        alternatives = {}
+        try:
+            if file.suffix in (".otf", ".ttf") and TTFont is not None and brotli:
+                font = TTFont(io.BytesIO(data))
+                font.flavor = "woff2"
+                out = io.BytesIO()
+                font.save(out)
+                alternatives[".woff2"] = out.getvalue()
+            elif file.suffix == ".png" and Image is not None:
+                out = io.BytesIO()
+                Image.open(io.BytesIO(data)).save(out, "WEBP", lossless=True)
+                if out.tell() < len(data):
+                    alternatives[".webp"] = out.getvalue()
+        except Exception as e:
+            logger.warning(f"Converting {file} failed: {e}")
+        return alternatives
+
+    def _rewrite(self, text: str) -> str:
+        def font(match: re.Match) -> str:
+            asset = self._assets.get(match["path"])
+            woff2 = asset and asset.alternatives.get("font/woff2")
+            if woff2 is None:
+                return match[0]
+            return (
+                f"url('{self.url(woff2.path)}') format('woff2'), "
+                f"url('{self.url(asset.path)}') format('{match['format']}')"
+            )
+
+        def plain(match: re.Match) -> str:
+            return self.url(match["path"])
+
+        prefix = re.escape(self.prefix)
+        text = re.sub(
+            rf"url\(['\"]?{prefix}/(?P<path>[\w./-]+\.(?:otf|ttf))['\"]?\)\s*"
+            rf"format\(['\"](?P<format>\w+)['\"]\)",
+            font,
+            text,
+        )
+        return re.sub(rf"{prefix}/(?P<path>[\w./-]+\.\w+)", plain, text)
+
+    def url(self, path: str) -> str:
+        """URL of ``path`` (relative to ``static/``), hashed if it's known."""
+        asset = self._assets.get(path)
+        if asset is None:
+            return f"{self.prefix}/{path}"
+        return f"{self.prefix}/{asset.url_path}"
+
+    def response(
+        self, request: Request, path: str, cache_control: str | None = None
+    ) -> Response:
+        try:
+            asset, hashed = self._routes[path]
+        except KeyError:
+            return Response(status_code=404)
+        vary = "Accept-Encoding"
+        # Images are swapped for a smaller format at the same URL, fonts
+        # have their own URL listed in the CSS.
+        images = {
+            media_type: alternative
+            for media_type, alternative in asset.alternatives.items()
+            if media_type.startswith("image/")
+        }
+        if images:
+            vary += ", Accept"
+            accept = request.headers.get("accept", "")
+            for media_type, alternative in images.items():
+                if media_type in accept:
+                    asset = alternative
+                    break
+
+        coding = _negotiate(request.headers.get("accept-encoding", ""), asset.bodies)
+        etag = f'"{asset.digest}-{coding}"'
+        headers = {
+            "Cache-Control": cache_control
+            or (IMMUTABLE if hashed else "public, max-age=3600"),
+            "ETag": etag,
+            "Vary": vary,
+        }
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return Response(
+            asset.bodies[coding], media_type=asset.media_type, headers=headers
+        )
+
+
+def _negotiate(accept_encoding: str, bodies: Dict[str, bytes]) -> str:
+    accepted = accepted_codings(accept_encoding)
+    for coding in ("br", "gzip"):
+        if coding in bodies and (coding in accepted or "*" in accepted):
+            return coding
+    return "identity"
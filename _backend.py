@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Tuple
+import abc
+import asyncio
+import json
+import sqlite3
+import time
+
+
+class Backend(abc.ABC):
+    """State that has to be shared by every worker serving the app.
+
+    Holds the app-wide Spotify request budget (a token bucket that can also
+    be blocked after a ``Retry-After``) and a small key/value store with
+    expiry, used for OAuth states and cached users.
+    """
+
+    async def setup(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def acquire(self, name: str, rate: float, capacity: float) -> float:
+        """Take one token from bucket ``name``.
+
+        Returns 0 when a token was taken, otherwise the number of seconds to
+        wait before trying again.
+        """
+
+    @abc.abstractmethod
+    async def block(self, name: str, seconds: float) -> None:
+        """Stop bucket ``name`` from handing out tokens for ``seconds``."""
+
+    @abc.abstractmethod
+    async def get(self, namespace: str, key: str) -> Any:
+        """Return the value stored under ``key`` or ``None``."""
+
+    @abc.abstractmethod
+    async def set(self, namespace: str, key: str, value: Any, ttl: float) -> None:
+        """Store ``value`` under ``key`` for ``ttl`` seconds."""
+
+    @abc.abstractmethod
+    async def pop(self, namespace: str, key: str) -> Any:
+        """Remove ``key`` and return its value, or ``None`` if it wasn't set."""
+
+    @abc.abstractmethod
+    async def claim(self, namespace: str, key: str, owner: str, ttl: float) -> bool:
+        """Set ``key`` to ``owner`` unless another owner holds it.
+
+        Claiming a key again extends it, so it works as a lease that one
+        worker holds for as long as it keeps renewing it.
+        """
+
+
+class MemoryBackend(Backend):
+    """Backend for a single process. This is the default."""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}
+        self._data: Dict[Tuple[str, str], Tuple[Any, float]] = {}
+        self._sets = 0
+
+    async def acquire(self, name: str, rate: float, capacity: float) -> float:
+        now = time.time()
+        tokens, updated, blocked_until = self._buckets.get(name, (capacity, now, 0))
+        if blocked_until > now:
+            return blocked_until - now
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self._buckets[name] = (tokens - 1, now, 0)
+            return 0
+        self._buckets[name] = (tokens, now, 0)
+        return (1 - tokens) / rate
+
+    async def block(self, name: str, seconds: float) -> None:
+        now = time.time()
+        tokens, updated, blocked_until = self._buckets.get(name, (0, now, 0))
+        self._buckets[name] = (0, now, max(blocked_until, now + seconds))
+
+    async def get(self, namespace: str, key: str) -> Any:
+        try:
+            value, expires = self._data[namespace, key]
+        except KeyError:
+            return None
+        if expires <= time.time():
+            del self._data[namespace, key]
+            return None
+        return value
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: float) -> None:
+        self._data[namespace, key] = (value, time.time() + ttl)
+        self._sets += 1
+        if self._sets % 1000 == 0:
+            self._purge()
+
+    async def pop(self, namespace: str, key: str) -> Any:
+        value = await self.get(namespace, key)
+        self._data.pop((namespace, key), None)
+        return value
+
+    async def claim(self, namespace: str, key: str, owner: str, ttl: float) -> bool:
+        if await self.get(namespace, key) not in (None, owner):
+            return False
+        await self.set(namespace, key, owner, ttl)
+        return True
+
+    def _purge(self) -> None:
+        now = time.time()
+        for k in [k for k, (_, expires) in self._data.items() if expires <= now]:
+            del self._data[k]
+
+
+class SQLiteBackend(Backend):
+    """Backend stored in a SQLite file that every worker on the host opens.
+
+    All queries run on one background thread so the event loop never waits
+    on disk I/O, and updates to a bucket happen in a single ``IMMEDIATE``
+    transaction so concurrent workers can't take the same token.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._sets = 0
+
+    async def setup(self) -> None:
+        await self._run(self._connect)
+
+    async def close(self) -> None:
+        if self._conn:
+            await self._run(self._conn.close)
+        self._executor.shutdown(wait=False)
+
+    def _connect(self) -> None:
+        self._conn = sqlite3.connect(
+            self.path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "name TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "namespace TEXT, key TEXT, value TEXT, expires REAL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._purge()
+
+    def _purge(self) -> None:
+        self._conn.execute("DELETE FROM kv WHERE expires <= ?", (time.time(),))
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, fn, *args
+        )
+
+    async def acquire(self, name: str, rate: float, capacity: float) -> float:
+        return await self._run(self._acquire, name, rate, capacity)
+
+    def _acquire(self, name: str, rate: float, capacity: float) -> float:
+        conn = self._conn
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?",
+                (name,),
+            ).fetchone()
+            tokens, updated, blocked_until = row or (capacity, now, 0)
+            if blocked_until > now:
+                return blocked_until - now
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, 0)",
+                (name, tokens, now),
+            )
+            return wait
+        finally:
+            conn.execute("COMMIT")
+
+    async def block(self, name: str, seconds: float) -> None:
+        await self._run(self._block, name, seconds)
+
+    def _block(self, name: str, seconds: float) -> None:
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO buckets VALUES (?, 0, ?, ?) ON CONFLICT (name) DO UPDATE "
+            "SET tokens = 0, updated = excluded.updated, "
+            "blocked_until = MAX(blocked_until, excluded.blocked_until)",
+            (name, now, now + seconds),
+        )
+
+    async def get(self, namespace: str, key: str) -> Any:
+        return await self._run(self._get, namespace, key)
+
+    def _get(self, namespace: str, key: str) -> Any:
+        row = self._conn.execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires > ?",
+            (namespace, key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: float) -> None:
+        await self._run(self._set, namespace, key, json.dumps(value), ttl)
+
+    def _set(self, namespace: str, key: str, value: str, ttl: float) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)",
+            (namespace, key, value, time.time() + ttl),
+        )
+        self._sets += 1
+        if self._sets % 1000 == 0:
+            self._purge()
+
+    async def pop(self, namespace: str, key: str) -> Any:
+        return await self._run(self._pop, namespace, key)
+
+    def _pop(self, namespace: str, key: str) -> Any:
+        row = self._conn.execute(
+            "DELETE FROM kv WHERE namespace = ? AND key = ? RETURNING value, expires",
+            (namespace, key),
+        ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    async def claim(self, namespace: str, key: str, owner: str, ttl: float) -> bool:
+        return await self._run(self._claim, namespace, key, json.dumps(owner), ttl)
+
+    def _claim(self, namespace: str, key: str, owner: str, ttl: float) -> bool:
+        conn = self._conn
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires > ?",
+                (namespace, key, now),
+            ).fetchone()
+            if row is not None and row[0] != owner:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)",
+                (namespace, key, owner, now + ttl),
+            )
+            return True
+        finally:
+            conn.execute("COMMIT")
+
+
+def create_backend(url: str | None) -> Backend:
+    """Create a backend from a URL such as ``sqlite:///tmp/unwrapped.db``."""
+    if not url or url == "memory://":
+        return MemoryBackend()
+    if url.startswith("sqlite://"):
+        return SQLiteBackend(url[len("sqlite://") :])
+    raise ValueError(f"Unsupported shared backend: {url}")
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Set
+import asyncio
+
+Fetch = Callable[[List[Hashable], Any], Awaitable[List[Any]]]
+
+
+class Batcher:
+    """Merges single-key lookups into calls to a bulk endpoint.
+
+    Keys passed to ``load`` within ``window`` seconds of the first one, from
+    any caller, are fetched together once ``max_size`` keys are waiting or
+    the window closes, whichever comes first. ``fetch(keys, context)``
+    returns one result per key, in order; ``context`` is the one given with
+    the first key of the batch (for Spotify, the user whose token is used).
+    """
+
+    def __init__(self, fetch: Fetch, *, max_size: int = 50, window: float = 0.005):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.window = window
+        self.batches = 0
+        self.keys = 0
+        self.requested = 0
+
+        self._pending: Dict[Hashable, List[asyncio.Future]] = {}
+        self._context: Any = None
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable, context: Any = None) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.requested += 1
+        if not self._pending:
+            self._context = context
+            self._timer = loop.call_later(self.window, self._dispatch)
+        self._pending.setdefault(key, []).append(future)
+        if len(self._pending) >= self.max_size:
+            self._dispatch()
+        return await future
+
+    def _dispatch(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch, self._context))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(
+        self, batch: Dict[Hashable, List[asyncio.Future]], context: Any
+    ) -> None:
+        self.batches += 1
+        self.keys += len(batch)
+        try:
+            results = await self.fetch(list(batch), context)
+        except BaseException as e:
+            # Waiters must not hang when the fetch is cancelled or interrupted.
+            cancelled = isinstance(e, asyncio.CancelledError)
+            for futures in batch.values():
+                for future in futures:
+                    if future.done():
+                        continue
+                    if cancelled:
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+            if cancelled or not isinstance(e, Exception):
+                raise
+            return
+        for futures, result in zip(batch.values(), results):
+            for future in futures:
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requested": self.requested,
+            "batches": self.batches,
+            "keys": self.keys,
+            "avg_batch": self.keys / self.batches if self.batches else 0,
+        }
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+import asyncio
+import functools
+import time
+
+
+class ResponseCache:
+    """LRU cache for decoded Spotify responses.
+
+    Entries expire after their own TTL and the cache evicts least recently
+    used entries once the summed response sizes go over ``max_bytes``.
+    Concurrent loads of the same key share a single upstream call.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+        self._entries: OrderedDict[Hashable, Tuple[float, int, Any]] = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        try:
+            expires, size, value = self._entries[key]
+        except KeyError:
+            raise KeyError(key) from None
+        if expires <= time.monotonic():
+            self._remove(key)
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self.size += size
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        ttl: float,
+        loader: Callable[[], Awaitable[Tuple[Any, int]]],
+    ) -> Any:
+        """Return the cached value for ``key`` or load it.
+
+        ``loader`` must return a ``(value, size)`` tuple. If a load for the
+        same key is already running, wait for it instead of starting another.
+        """
+        try:
+            value = self.get(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # A task of its own, so cancelling the caller that started the
+            # load doesn't cancel it for the others waiting on it.
+            task = asyncio.create_task(self._load(key, ttl, loader))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._loaded, key))
+        return await asyncio.shield(task)
+
+    async def _load(
+        self,
+        key: Hashable,
+        ttl: float,
+        loader: Callable[[], Awaitable[Tuple[Any, int]]],
+    ) -> Any:
+        value, size = await loader()
+        self.set(key, value, ttl, size)
+        return value
+
+    def _loaded(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Retrieved, so it isn't logged when nobody waits on it.
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
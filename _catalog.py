@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Sequence, Tuple, TYPE_CHECKING
+import asyncio
+import datetime
+import functools
+import time
+
+import pytz
+
+from _batcher import Batcher
+from models import Album, Artist, CatalogItem, Track, User, dumps, loads
+
+if TYPE_CHECKING:
+    from _http import HTTP
+
+# Most ids /v1/tracks and /v1/artists take per request.
+BATCH_SIZE = 50
+
+
+class _Table:
+    """LRU of catalog objects by Spotify id, with a TTL per entry."""
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, id: str) -> Any:
+        entry = self._entries.get(id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[id]
+            return None
+        self._entries.move_to_end(id)
+        return entry[1]
+
+    def set(self, id: str, value: Any) -> None:
+        self._entries[id] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(id)
+        if len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+
+class Catalog:
+    """Tracks, artists and albums shared by every user.
+
+    Catalog data isn't user specific, so each entity is kept once and the
+    same object is handed to everyone (``intern_*``). Lookups by id are
+    served from memory, then from the ``CatalogItem`` table when
+    ``persist`` is on, and only then from Spotify's multi-id endpoints.
+    Misses from all callers within ``batch_window`` seconds are merged into
+    calls of up to ``BATCH_SIZE`` ids, and concurrent lookups of the same
+    id share one fetch.
+
+    Artists nested in tracks and albums are simplified (no genres or
+    images); a full artist replaces the fields of the interned one in
+    place, so every track holding it sees them.
+    """
+
+    def __init__(
+        self,
+        http: HTTP,
+        *,
+        max_items: int = 100_000,
+        ttl: float = 24 * 60 * 60,
+        persist: bool = False,
+        persist_ttl: float = 7 * 24 * 60 * 60,
+        batch_window: float = 0.005,
+    ):
+        self.http = http
+        self.persist = persist
+        self.persist_ttl = persist_ttl
+        self.tracks = _Table(max_items, ttl)
+        self.artists = _Table(max_items, ttl)
+        self.albums = _Table(max_items, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._batchers = {
+            kind: Batcher(
+                self._fetcher(f"{kind}s"), max_size=BATCH_SIZE, window=batch_window
+            )
+            for kind in ("track", "artist")
+        }
+
+    def _fetcher(self, type: str):
+        async def fetch(ids: List[str], user: User) -> List[Dict[str, Any] | None]:
+            return await self.http.get_several(user, type, ids)
+
+        return fetch
+
+    def intern_artist(self, artist: Artist) -> Artist:
+        known = self.artists.get(artist.id)
+        if known is None:
+            self.artists.set(artist.id, artist)
+            return artist
+        if artist.genres is not None and known.genres is None:
+            for field in Artist.__dataclass_fields__:
+                setattr(known, field, getattr(artist, field))
+        return known
+
+    def intern_album(self, album: Album) -> Album:
+        known = self.albums.get(album.id)
+        if known is not None:
+            return known
+        if album.artists:
+            album.artists = [self.intern_artist(a) for a in album.artists]
+        self.albums.set(album.id, album)
+        return album
+
+    def intern_parts(self, track: Track) -> Track:
+        """Share the artists and album of ``track`` but not the track itself.
+
+        For tracks that carry per-user fields, like ``PlaylistTrack``.
+        """
+        track.artists = [self.intern_artist(a) for a in track.artists]
+        track.album = self.intern_album(track.album)
+        return track
+
+    def intern_track(self, track: Track) -> Track:
+        known = self.tracks.get(track.id)
+        if known is not None:
+            return known
+        self.intern_parts(track)
+        self.tracks.set(track.id, track)
+        return track
+
+    async def get_tracks(self, user: User, ids: Sequence[str]) -> List[Track | None]:
+        """Tracks in the order of ``ids``; ``None`` for unknown ids."""
+        found = await self._get("track", user, ids)
+        return [found.get(id) for id in ids]
+
+    async def get_artists(
+        self, user: User, ids: Sequence[str]
+    ) -> List[Artist | None]:
+        """Full artists (with genres and images) in the order of ``ids``."""
+        found = await self._get("artist", user, ids)
+        return [found.get(id) for id in ids]
+
+    def _cached(self, kind: str, id: str) -> Any:
+        if kind == "track":
+            return self.tracks.get(id)
+        artist = self.artists.get(id)
+        # Simplified artists don't count, genres are what callers want.
+        return artist if artist is not None and artist.genres is not None else None
+
+    def _intern(self, kind: str, data: Dict[str, Any]) -> Any:
+        if kind == "track":
+            return self.intern_track(Track.from_json(data))
+        return self.intern_artist(Artist.from_json(data))
+
+    async def _get(self, kind: str, user: User, ids: Sequence[str]) -> Dict[str, Any]:
+        found = {}
+        waiting = {}
+        missing = []
+        for id in dict.fromkeys(ids):
+            value = self._cached(kind, id)
+            if value is not None:
+                self.hits += 1
+                found[id] = value
+            elif (kind, id) in self._inflight:
+                self.hits += 1
+                waiting[id] = self._inflight[kind, id]
+            else:
+                self.misses += 1
+                missing.append(id)
+
+        if missing:
+            # In a task of its own, so a cancelled caller doesn't cancel the
+            # lookup for everyone else waiting on it.
+            task = asyncio.create_task(self._load(kind, user, missing))
+            for id in missing:
+                self._inflight[kind, id] = task
+                waiting[id] = task
+            task.add_done_callback(functools.partial(self._loaded, kind, missing))
+
+        for id, task in waiting.items():
+            found[id] = (await asyncio.shield(task)).get(id)
+        return found
+
+    def _loaded(self, kind: str, ids: List[str], task: asyncio.Task) -> None:
+        for id in ids:
+            if self._inflight.get((kind, id)) is task:
+                del self._inflight[kind, id]
+        # Retrieved, so it isn't logged when nobody waits on it.
+        if not task.cancelled():
+            task.exception()
+
+    async def _load(self, kind: str, user: User, ids: List[str]) -> Dict[str, Any]:
+        found = {}
+        if self.persist:
+            fresh_after = datetime.datetime.now(pytz.utc) - datetime.timedelta(
+                seconds=self.persist_ttl
+            )
+            rows = await CatalogItem.filter(
+                kind=kind, spotify_id__in=ids, updated_at__gte=fresh_after
+            ).values_list("spotify_id", "data")
+            for id, data in rows:
+                found[id] = self._intern(kind, loads(data))
+            ids = [id for id in ids if id not in found]
+
+        batcher = self._batchers[kind]
+        results = await asyncio.gather(*[batcher.load(id, user) for id in ids])
+        # One row per id: an upsert may not touch a row twice, and a batch
+        # can return the same item for several requested ids.
+        items = {item["id"]: item for item in results if item}
+        self.fetched += len(items)
+        # Keyed by the requested id, relinked tracks come back with another.
+        for id, item in zip(ids, results):
+            if item:
+                found[id] = self._intern(kind, item)
+
+        if self.persist and items:
+            now = datetime.datetime.now(pytz.utc)
+            await CatalogItem.bulk_create(
+                [
+                    CatalogItem(
+                        kind=kind,
+                        spotify_id=item["id"],
+                        data=dumps(item).decode(),
+                        updated_at=now,
+                    )
+                    for item in items.values()
+                ],
+                on_conflict=("kind", "spotify_id"),
+                update_fields=("data", "updated_at"),
+            )
+        return found
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tracks": len(self.tracks),
+            "artists": len(self.artists),
+            "albums": len(self.albums),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetched": self.fetched,
+            "batches": {kind: b.stats() for kind, b in self._batchers.items()},
+        }
@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Set, Tuple, TYPE_CHECKING
+import asyncio
+import datetime
+import logging
+import uuid
+
+import tortoise
+from tortoise.transactions import in_transaction
+
+import _rollups
+from _http import seconds_until
+from models import Play, User
+
+if TYPE_CHECKING:
+    from _http import HTTP
+
+logger = logging.getLogger(__name__)
+
+# Most plays /me/player/recently-played returns per request.
+PAGE_LIMIT = 50
+
+# Seconds the worker that polls holds the lease without renewing it.
+LEASE_TTL = 60
+
+
+def parse_played_at(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class HistoryIngestor:
+    """Copies active users' recently played tracks into the ``Play`` table.
+
+    Spotify only keeps the last 50 plays, so each user is polled once per
+    ``interval``. Only users whose access token is still valid are polled:
+    the refresh scheduler keeps tokens fresh for users seen recently, and
+    polling never refreshes one itself, so idle users drop out within an
+    hour. One worker polls at a time, the one holding a lease in the
+    shared backend. Polls are spread evenly over the interval, but no more
+    than ``max_rate`` per second so pages keep most of the request budget,
+    walk the users in id order so everyone gets a turn, and run at most
+    ``concurrency`` at once through the normal rate-limited request path.
+    New plays are buffered and written in batches, together with the
+    rollups they add to (see ``_rollups``); plays that are already stored
+    are skipped.
+    """
+
+    def __init__(
+        self,
+        http: HTTP,
+        *,
+        interval: float = 30 * 60,
+        concurrency: int = 2,
+        max_rate: float = 2,
+        batch_size: int = 500,
+        flush_interval: float = 5,
+        chunk_size: int = 1000,
+    ):
+        self.http = http
+        self.backend = http.client.backend
+        self.interval = interval
+        self.concurrency = concurrency
+        self.max_rate = max_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.polled = 0
+        self.skipped = 0
+        self.ingested = 0
+        self.failed = 0
+        self.leader = False
+
+        self._owner = uuid.uuid4().hex
+        self._lease_checked = float("-inf")
+        # Last play stored per user, and last play buffered in _pending.
+        self._cursors: Dict[int, int] = {}
+        self._fetched: Dict[int, int] = {}
+        self._pending: List[Tuple[Play, Tuple[str, ...]]] = []
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+        self._flush_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        for coro in (self._run(), self._flush_periodically()):
+            task = asyncio.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self.leader:
+            await self.backend.pop("lease", "history")
+        await self.flush()
+
+    async def _lease(self) -> bool:
+        """Whether this worker should poll, renewing the lease when it's due."""
+        now = asyncio.get_running_loop().time()
+        if now - self._lease_checked >= LEASE_TTL / 3:
+            self._lease_checked = now
+            try:
+                self.leader = await self.backend.claim(
+                    "lease", "history", self._owner, LEASE_TTL
+                )
+            except Exception as e:
+                logger.warning(f"Claiming the history sync lease failed: {e}")
+                self.leader = False
+        return self.leader
+
+    async def _sleep(self, seconds: float) -> None:
+        """Sleep, keeping the lease while at it."""
+        loop = asyncio.get_running_loop()
+        end = loop.time() + seconds
+        while (left := end - loop.time()) > 0:
+            await asyncio.sleep(min(left, LEASE_TTL / 3))
+            await self._lease()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not await self._lease():
+                await asyncio.sleep(LEASE_TTL / 3)
+                continue
+            started = loop.time()
+            try:
+                await self._cycle()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"History sync cycle failed: {e}")
+            await self._sleep(max(0, self.interval - (loop.time() - started)))
+
+    def _active_users(self):
+        # Tokens are only refreshed for users seen recently, so a valid one
+        # is what marks a user as active.
+        valid_after = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=self.http.TOKEN_REFRESH_MARGIN
+        )
+        return User.filter(refresh_token__isnull=False, token_expires__gt=valid_after)
+
+    async def _cycle(self) -> None:
+        total = await self._active_users().count()
+        if not total:
+            return
+        spacing = max(self.interval / total, 1 / self.max_rate)
+        last_id = 0
+        while True:
+            ids = (
+                await self._active_users()
+                .filter(id__gt=last_id)
+                .order_by("id")
+                .limit(self.chunk_size)
+                .values_list("id", flat=True)
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            for user_id in ids:
+                if not await self._lease():
+                    return
+                await self._slots.acquire()
+                task = asyncio.create_task(self._poll(user_id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                await asyncio.sleep(spacing)
+
+    async def _poll(self, user_id: int) -> None:
+        try:
+            user = await User.get(id=user_id)
+            if seconds_until(user.token_expires) <= self.http.TOKEN_REFRESH_MARGIN:
+                # Polling must not keep an idle user's token alive.
+                self.skipped += 1
+                return
+            await self.sync(user)
+        except tortoise.exceptions.DoesNotExist:
+            self._cursors.pop(user_id, None)
+            self._fetched.pop(user_id, None)
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"History sync for user {user_id} failed: {e}")
+        finally:
+            self._slots.release()
+
+    async def sync(self, user: User) -> int:
+        """Fetch and buffer every play of ``user`` newer than the last one stored."""
+        after = await self._cursor(user.id)
+        added = 0
+        while True:
+            previous = after
+            plays = await self.http.get_recently_played(user, after=after)
+            # Nested artists have no genres; the catalog fills them in.
+            genres = {
+                artist.id: artist.genres or ()
+                for artist in await self.http.get_artists(
+                    user, list({a.id for _, track in plays for a in track.artists})
+                )
+            }
+            for played_at, track in plays:
+                played_at = parse_played_at(played_at)
+                track_genres = {
+                    genre
+                    for artist in track.artists
+                    for genre in genres.get(artist.id, ())
+                }
+                play = Play(
+                    user_id=user.id,
+                    played_at=played_at,
+                    track_id=track.id,
+                    album_id=track.album.id,
+                    artist_ids=",".join(a.id for a in track.artists),
+                    ms_played=track.duration_ms,
+                )
+                self._pending.append((play, tuple(sorted(track_genres))))
+                after = max(after or 0, int(played_at.timestamp() * 1000))
+            added += len(plays)
+            if len(plays) < PAGE_LIMIT or after == previous:
+                break
+
+        self.polled += 1
+        if after is not None:
+            # The cursor only moves past these plays once they are stored.
+            self._fetched[user.id] = after
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        return added
+
+    async def _cursor(self, user_id: int) -> int | None:
+        try:
+            return self._cursors[user_id]
+        except KeyError:
+            pass
+        last = (
+            await Play.filter(user_id=user_id)
+            .order_by("-played_at")
+            .first()
+            .values_list("played_at", flat=True)
+        )
+        if last is None:
+            return None
+        return int(last.timestamp() * 1000)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"Writing plays failed: {e}")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            pending, self._pending = self._pending, []
+            fetched, self._fetched = self._fetched, {}
+            if not pending:
+                self._cursors.update(fetched)
+                return
+            try:
+                async with in_transaction() as connection:
+                    new = await self._unstored(pending, connection)
+                    await Play.bulk_create(
+                        [play for play, _ in new],
+                        batch_size=self.batch_size,
+                        using_db=connection,
+                    )
+                    await _rollups.add_plays(new, connection)
+            except Exception:
+                # Try again on the next flush. If another worker stored some
+                # of these plays first, that flush skips them.
+                self._pending[:0] = pending
+                for user_id, after in fetched.items():
+                    self._fetched.setdefault(user_id, after)
+                raise
+            self._cursors.update(fetched)
+            self.ingested += len(new)
+
+    @staticmethod
+    async def _unstored(
+        pending: Iterable[Tuple[Play, Tuple[str, ...]]], connection
+    ) -> List[Tuple[Play, Tuple[str, ...]]]:
+        """Drop plays that are already in the table or repeated in ``pending``."""
+        pending = list(pending)
+        stored = set(
+            await Play.filter(
+                user_id__in={play.user_id for play, _ in pending},
+                played_at__gte=min(play.played_at for play, _ in pending),
+            )
+            .using_db(connection)
+            .values_list("user_id", "played_at")
+        )
+        new = []
+        for play, genres in pending:
+            key = (play.user_id, play.played_at)
+            if key not in stored:
+                stored.add(key)
+                new.append((play, genres))
+        return new
+
+
+async def history_stats(
+    user: User, start: datetime.date, end: datetime.date, limit: int = 10
+) -> Dict[str, object]:
+    """Totals and top items for the days in ``[start, end)``.
+
+    Reads only the rollups, never the plays themselves.
+    """
+    plays, ms_played = await _rollups.totals(user, start, end)
+    top = await asyncio.gather(
+        *[_rollups.top_items(user, kind, start, end, limit) for kind in _rollups.KINDS]
+    )
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "plays": plays,
+        "ms_played": ms_played,
+        **{f"top_{kind}s": items for kind, items in zip(_rollups.KINDS, top)},
+    }
@@ -1,96 +1,348 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List, Tuple, TYPE_CHECKING
+from typing import Any, AsyncIterator, Dict, List, Tuple, TYPE_CHECKING
 import aiohttp
 import bcrypt
+import cachetools
 import datetime
 import pytz
 import tortoise
 import logging
 import asyncio
+import contextlib
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from models import User, Playlist, Track, Artist, Album, PlaylistTrack
+import _metrics
+from _cache import ResponseCache
+from _catalog import Catalog
+from _playlists import PlaylistStore
+from _ratelimit import RateLimiter
+from models import User, Playlist, Track, Artist, PlaylistTrack, loads
 
 if TYPE_CHECKING:
     from main import Client
 
+logger = logging.getLogger(__name__)
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, text: str, retry_after: float = 0):
+        self.status = status
+        self.text = text
+        self.retry_after = retry_after
+        super().__init__(f"HTTP Error: {status}, {text}")
+
+
+def seconds_until(when: datetime.datetime | None) -> float:
+    if when is None:
+        return 0
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=pytz.utc)
+    return (when - datetime.datetime.now(pytz.utc)).total_seconds()
+
 
 class HTTP:
     client: Client
     session: aiohttp.ClientSession
     _global_semaphore: asyncio.Semaphore
-    _user_locks: Dict[str, asyncio.Lock]
-    _user_rate_limits: Dict[str, int]
+    _user_slots: Dict[str, List[Any]]
+    limiter: RateLimiter
+    cache: ResponseCache
+    catalog: Catalog
+    playlists: PlaylistStore
+    _refreshing: Dict[int, asyncio.Task]
+    _recent_tokens: cachetools.TTLCache
+
+    # Seconds a GET response stays cached. Top items only change about daily
+    # while playlists can be edited at any time, so they expire quickly.
+    CACHE_TTLS = {
+        "playlists": 60,
+        "playlist": 30,
+        "playlist_tracks": 60,
+        "top": 3600,
+    }
+
+    # Refresh an access token inline when it expires within this many seconds.
+    TOKEN_REFRESH_MARGIN = 60
+
+    # Attempts after the first one for 429s, 5xx responses and connection
+    # errors. Only GET requests are retried on 5xx and connection errors.
+    MAX_RETRIES = 4
+
+    PLAYLIST_TRACK_FIELDS = (
+        "items(added_at,added_by.id,track(id,name,uri,duration_ms,popularity,"
+        "explicit,artists(id,name,uri),album(id,name,uri,images,artists(id,name,uri))))"
+    )
 
     def __init__(self, client: Client):
         self.client = client
         self.session = None
+        # Overridable so the app can run against a local stand-in (bench/).
+        self.api_url = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com")
+        self.accounts_url = os.getenv(
+            "SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com"
+        )
 
-        self._global_semaphore = asyncio.Semaphore(10)
-        self._user_locks = {}
-        self._user_rate_limits = {}
+        # Concurrent requests to Spotify per worker. The connection pool is
+        # sized to match so a request holding a slot never waits for a socket.
+        self.concurrency = int(os.getenv("SPOTIFY_CONCURRENCY", 10))
+        self._global_semaphore = asyncio.Semaphore(self.concurrency)
+        self._pool_waits = 0
+        self._pool_wait_time = 0.0
+        # Requests waiting for a per-user or a global slot.
+        self.queued = 0
+        # Requests one user may have in flight at once, so a single page can
+        # fan out without one user taking over the global pool.
+        self.per_user_limit = int(os.getenv("PER_USER_CONCURRENCY", 4))
+        self._user_slots = {}
+        self.limiter = RateLimiter(
+            client.backend,
+            float(os.getenv("SPOTIFY_RATE_LIMIT", 20)),
+            float(os.getenv("SPOTIFY_RATE_BURST", 40)),
+        )
+        self.cache = ResponseCache(
+            int(os.getenv("RESPONSE_CACHE_MB", 32)) * 1024 * 1024
+        )
+        self.catalog = Catalog(
+            self,
+            max_items=int(os.getenv("CATALOG_MAX_ITEMS", 100_000)),
+            persist=os.getenv("CATALOG_DB", "").lower() in ("1", "true", "yes"),
+            batch_window=float(os.getenv("BATCH_WINDOW_MS", 5)) / 1000,
+        )
+        self.playlists = PlaylistStore(
+            self, max_tracks=int(os.getenv("PLAYLIST_STORE_TRACKS", 200_000))
+        )
+        # bcrypt releases the GIL, so key hashing runs on a few threads and
+        # scales with cores without blocking the event loop.
+        self._auth_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("AUTH_WORKERS", min(4, os.cpu_count() or 1))),
+            thread_name_prefix="auth",
+        )
+        self.session_key_type = os.getenv("SESSION_KEY_TYPE", "bcrypt")
+        self._refreshing = {}
+        # Other User instances for the same row may still hold the old token,
+        # so remember fresh ones long enough for cached copies to catch up.
+        self._recent_tokens = cachetools.TTLCache(maxsize=10_000, ttl=120)
 
     async def setup(self):
-        self.session = aiohttp.ClientSession()
+        self.session = self._create_session()
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.concurrency,
+            ttl_dns_cache=int(os.getenv("HTTP_DNS_TTL", 300)),
+            keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE", 60)),
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=float(os.getenv("HTTP_TOTAL_TIMEOUT", 20)),
+            connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+            sock_read=float(os.getenv("HTTP_READ_TIMEOUT", 10)),
+        )
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(self._on_pool_wait_start)
+        trace.on_connection_queued_end.append(self._on_pool_wait_end)
+        return aiohttp.ClientSession(
+            connector=connector, timeout=timeout, trace_configs=[trace]
+        )
+
+    async def _on_pool_wait_start(self, session, ctx, params) -> None:
+        ctx.pool_wait_start = asyncio.get_running_loop().time()
+
+    async def _on_pool_wait_end(self, session, ctx, params) -> None:
+        self._pool_waits += 1
+        self._pool_wait_time += asyncio.get_running_loop().time() - ctx.pool_wait_start
+
+    def pool_stats(self) -> Dict[str, Any]:
+        connector = self.session.connector if self.session else None
+        if connector is None:
+            return {}
+        # aiohttp has no public API for these, so read them defensively.
+        idle = getattr(connector, "_conns", {})
+        acquired = getattr(connector, "_acquired", ())
+        waiters = getattr(connector, "_waiters", {})
+        return {
+            "limit": connector.limit,
+            "idle": sum(len(conns) for conns in idle.values()),
+            "acquired": len(acquired),
+            "open": sum(len(conns) for conns in idle.values()) + len(acquired),
+            "waiting": sum(len(w) for w in waiters.values()),
+            "waits": self._pool_waits,
+            "wait_time": self._pool_wait_time,
+        }
 
     async def close(self):
         if self.session:
             await self.session.close()
 
-    async def _get_user_lock(self, user_id: str) -> asyncio.Lock:
-        """Get or create a lock for each user to handle rate limits."""
-        if user_id not in self._user_locks:
-            self._user_locks[user_id] = asyncio.Lock()
-        return self._user_locks[user_id]
+    @contextlib.asynccontextmanager
+    async def _user_slot(self, user_id: str | None) -> AsyncIterator[None]:
+        """Limit concurrent requests per user.
+
+        Entries only live while the user has requests queued or in flight.
+        """
+        if user_id is None:
+            yield
+            return
 
-    async def request(self, method, url, user_id=None, **kwargs):
+        entry = self._user_slots.get(user_id)
+        if entry is None:
+            entry = self._user_slots[user_id] = [
+                asyncio.Semaphore(self.per_user_limit),
+                0,
+            ]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_slots[user_id]
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, user_id: str | None) -> AsyncIterator[None]:
+        """A per-user and a global slot, timing the wait for them."""
+        start = time.perf_counter()
+        self.queued += 1
+        acquired = False
+        try:
+            async with self._user_slot(user_id), self._global_semaphore:
+                acquired = True
+                self.queued -= 1
+                _metrics.SLOT_WAIT.observe(time.perf_counter() - start)
+                yield
+        finally:
+            if not acquired:
+                self.queued -= 1
+
+    async def request(self, method, url, user=None, cache_ttl=None, **kwargs):
+        if user is not None:
+            await self.ensure_token(user)
+
+        if cache_ttl and method == "GET":
+            if user is not None:
+                identity = user.spotify_id
+            else:
+                identity = kwargs.get("headers", {}).get("Authorization")
+            params = kwargs.get("params")
+            key = (
+                identity,
+                url,
+                tuple(sorted(params.items())) if params else (),
+            )
+            return await self.cache.get_or_load(
+                key,
+                cache_ttl,
+                lambda: self._user_request(method, url, user, **kwargs),
+            )
+        data, _ = await self._user_request(method, url, user, **kwargs)
+        return data
+
+    async def _user_request(self, method, url, user=None, **kwargs):
+        if user is None:
+            return await self._request(method, url, **kwargs)
+
+        headers = kwargs.pop("headers", {})
+        token = user.access_token
+        try:
+            return await self._request(
+                method,
+                url,
+                user.spotify_id,
+                headers={**headers, "Authorization": f"Bearer {token}"},
+                **kwargs,
+            )
+        except HTTPError as e:
+            if e.status != 401:
+                raise
+
+        self._sync_token(user)
+        if user.access_token == token:
+            await self.ensure_token(user, force=True)
+        return await self._request(
+            method,
+            url,
+            user.spotify_id,
+            headers={**headers, "Authorization": f"Bearer {user.access_token}"},
+            **kwargs,
+        )
+
+    async def _request(self, method, url, user_id=None, **kwargs):
         if not self.session:
-            self.session = aiohttp.ClientSession()
+            self.session = self._create_session()
 
-        async with self._global_semaphore:
-            if user_id:
-                async with await self._get_user_lock(user_id):
-                    return await self._make_request_with_retry(
-                        method, url, user_id, **kwargs
+        for attempt in range(self.MAX_RETRIES + 1):
+            # Wait for the rate limit before taking a slot, so that backing
+            # off never keeps a slot away from other requests.
+            await self.limiter.acquire()
+            try:
+                async with self._slot(user_id):
+                    self.limiter.in_flight += 1
+                    try:
+                        result = await self._send(method, url, **kwargs)
+                    finally:
+                        self.limiter.in_flight -= 1
+            except HTTPError as e:
+                if e.status == 429:
+                    _metrics.RATE_LIMITED.inc(endpoint=_metrics.endpoint(url))
+                    _metrics.RETRY_AFTER.inc(e.retry_after)
+                    await self.limiter.throttle(e.retry_after)
+                    if attempt == self.MAX_RETRIES:
+                        raise
+                    logger.warning(
+                        f"Rate limit hit, pausing requests for {e.retry_after} seconds..."
                     )
+                    self.limiter.retries += 1
+                    continue
+                if e.status < 500 or method != "GET" or attempt == self.MAX_RETRIES:
+                    raise
+                error = e
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.MAX_RETRIES or method != "GET":
+                    raise
+                error = e
             else:
-                return await self._make_request_with_retry(
-                    method, url, user_id, **kwargs
-                )
-
-    async def _make_request_with_retry(self, method, url, user_id=None, **kwargs):
-        retry_after = self._user_rate_limits.get(user_id, 0)
-        if retry_after:
-            logging.warning(
-                f"User {user_id} is rate limited. Retrying after {retry_after} seconds..."
+                self.limiter.success()
+                return result
+
+            delay = self.limiter.backoff(attempt)
+            logger.warning(
+                f"{method} {url} failed ({error!r}), retrying in {delay:.2f} seconds..."
+            )
+            self.limiter.retries += 1
+            await asyncio.sleep(delay)
+
+    async def _send(self, method, url, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                status = response.status
+                if response.status >= 400:
+                    raise HTTPError(
+                        response.status,
+                        await response.text(),
+                        retry_after=int(response.headers.get("Retry-After", 1)),
+                    )
+
+                if response.content_type != "application/json":
+                    raise Exception(await response.text())
+                body = await response.read()
+                return loads(body), len(body)
+        finally:
+            _metrics.UPSTREAM_LATENCY.observe(
+                time.perf_counter() - start,
+                method=method,
+                endpoint=_metrics.endpoint(url),
+                status=status,
             )
-            await asyncio.sleep(retry_after)
-
-        async with self.session.request(method, url, **kwargs) as response:
-            if response.status == 429:
-                retry_after = int(response.headers.get("Retry-After", 1))
-                logging.warning(
-                    f"Rate limit hit for user {user_id}, retrying after {retry_after} seconds..."
-                )
-                self._user_rate_limits[user_id] = retry_after
-                await asyncio.sleep(retry_after)
-                return await self._make_request_with_retry(
-                    method, url, user_id, **kwargs
-                )
-
-            if response.status >= 400:
-                raise Exception(
-                    f"HTTP Error: {response.status}, {await response.text()}"
-                )
-
-            self._user_rate_limits[user_id] = 0
-            try:
-                return await response.json()
-            except aiohttp.ContentTypeError:
-                raise Exception(await response.text())
 
     async def refresh_token(self, user) -> None:
-        url = "https://accounts.spotify.com/api/token"
+        url = f"{self.accounts_url}/api/token"
         data = await self.request(
             "POST",
             url,
@@ -108,9 +360,38 @@ class HTTP:
             seconds=data["expires_in"]
         )
         await user.save()
+        self._remember_token(user)
+        await self.client.users.put(user)
+
+    async def ensure_token(self, user: User, force: bool = False) -> None:
+        """Make sure ``user`` holds an access token that isn't about to expire.
+
+        Concurrent refreshes for the same user share one call to
+        :meth:`refresh_token`.
+        """
+        self._sync_token(user)
+        if not force and seconds_until(user.token_expires) > self.TOKEN_REFRESH_MARGIN:
+            return
+
+        task = self._refreshing.get(user.id)
+        if task is None:
+            task = asyncio.create_task(self.refresh_token(user))
+            self._refreshing[user.id] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(user.id, None))
+        await asyncio.shield(task)
+        self._sync_token(user)
+
+    def _remember_token(self, user: User) -> None:
+        self._recent_tokens[user.id] = (user.access_token, user.token_expires)
+
+    def _sync_token(self, user: User) -> None:
+        try:
+            user.access_token, user.token_expires = self._recent_tokens[user.id]
+        except KeyError:
+            pass
 
     async def get_user_data(self, code: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        url = "https://accounts.spotify.com/api/token"
+        url = f"{self.accounts_url}/api/token"
         data = await self.request(
             "POST",
             url,
@@ -127,7 +408,7 @@ class HTTP:
         access_token = data["access_token"]
         token_type = data["token_type"]
 
-        url = "https://api.spotify.com/v1/me"
+        url = f"{self.api_url}/v1/me"
         user_data = await self.request(
             "GET",
             url,
@@ -137,6 +418,19 @@ class HTTP:
         )
         return user_data, data
 
+    async def new_session_key(self, spotify_id: str) -> str:
+        """Key that identifies a user in their session cookie.
+
+        Nothing ever checks it against the Spotify id, so ``random`` keys
+        work as well as the default bcrypt hash and cost nothing to make.
+        """
+        if self.session_key_type == "random":
+            return secrets.token_urlsafe(32)
+        hashed = await asyncio.get_running_loop().run_in_executor(
+            self._auth_executor, bcrypt.hashpw, spotify_id.encode(), bcrypt.gensalt()
+        )
+        return hashed.decode()
+
     async def get_or_create_user(self, user_data, token_data) -> User:
         access_token = token_data["access_token"]
         expires_in = token_data["expires_in"]
@@ -153,7 +447,7 @@ class HTTP:
                 spotify_id=user_data["id"],
                 access_token=access_token,
                 refresh_token=refresh_token,
-                token_expires=datetime.datetime.now()
+                token_expires=datetime.datetime.now(pytz.utc)
                 + datetime.timedelta(seconds=expires_in),
                 display_name=user_data["display_name"],
                 email=user_data["email"],
@@ -161,12 +455,12 @@ class HTTP:
                 image=img_url,
                 country=user_data["country"],
                 product=user_data["product"],
-                key=bcrypt.hashpw(user_data["id"].encode(), bcrypt.gensalt()).decode(),
+                key=await self.new_session_key(user_data["id"]),
             )
         else:
             user.access_token = access_token
             user.refresh_token = refresh_token
-            user.token_expires = datetime.datetime.now() + datetime.timedelta(
+            user.token_expires = datetime.datetime.now(pytz.utc) + datetime.timedelta(
                 seconds=expires_in
             )
             user.display_name = user_data["display_name"]
@@ -176,247 +470,146 @@ class HTTP:
             user.country = user_data["country"]
             user.product = user_data["product"]
         await user.save()
+        self._remember_token(user)
+        await self.client.users.put(user)
         return user
 
     async def get_user_playlists(
         self, user, limit: int = 20, offset: int = 0
     ) -> List[Playlist]:
-        url = "https://api.spotify.com/v1/me/playlists"
+        url = f"{self.api_url}/v1/me/playlists"
         data = await self.request(
             "GET",
             url,
-            headers={
-                "Authorization": f"Bearer {user.access_token}",
-            },
+            user=user,
+            cache_ttl=self.CACHE_TTLS["playlists"],
             params={
                 "limit": limit,
                 "offset": offset,
             },
         )
-
-        playlists = []
-        for item in data["items"]:
-            try:
-                img_url = item["images"][0]["url"]
-            except IndexError:
-                img_url = None
-            playlist = Playlist(
-                id=item["id"],
-                name=item["name"],
-                collaborative=item["collaborative"],
-                description=item["description"],
-                href=item["href"],
-                image=img_url,
-                owner_id=item["owner"]["id"],
-                owner_name=item["owner"]["display_name"],
-                public=item["public"],
-                snapshot_id=item["snapshot_id"],
-                track_href=item["tracks"]["href"],
-                track_count=item["tracks"]["total"],
-            )
-            playlists.append(playlist)
-        return playlists
+        return [Playlist.from_json(item) for item in data["items"]]
 
     async def get_playlist(self, user: User, playlist_id: str) -> Playlist:
-        url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
+        url = f"{self.api_url}/v1/playlists/{playlist_id}"
         data = await self.request(
             "GET",
             url,
-            headers={
-                "Authorization": f"Bearer {user.access_token}",
-            },
+            user=user,
+            cache_ttl=self.CACHE_TTLS["playlist"],
             params={
                 "offset": 0,
                 "limit": 0,
                 "fields": "id,name,description,href,images,owner,public,snapshot_id,collaborative,tracks(total,href)",
             },
         )
-        try:
-            img_url = data["images"][0]["url"]
-        except IndexError:
-            img_url = None
-        playlist = Playlist(
-            id=data["id"],
-            name=data["name"],
-            collaborative=data["collaborative"],
-            description=data["description"],
-            href=data["href"],
-            image=img_url,
-            owner_id=data["owner"]["id"],
-            owner_name=data["owner"]["display_name"],
-            public=data["public"],
-            snapshot_id=data["snapshot_id"],
-            track_href=data["tracks"]["href"],
-            track_count=data["tracks"]["total"],
-        )
-        return playlist
+        return Playlist.from_json(data)
 
     async def get_playlist_tracks(
-        self, user: User, playlist_id: str, limit: int = 20, offset: int = 0
+        self,
+        user: User,
+        playlist_id: str,
+        limit: int = 20,
+        offset: int = 0,
+        cache: bool = True,
     ) -> List[PlaylistTrack]:
-        url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+        url = f"{self.api_url}/v1/playlists/{playlist_id}/tracks"
         data = await self.request(
             "GET",
             url,
-            headers={
-                "Authorization": f"Bearer {user.access_token}",
-            },
+            user=user,
+            cache_ttl=self.CACHE_TTLS["playlist_tracks"] if cache else None,
             params={
                 "limit": limit,
                 "offset": offset,
+                "fields": self.PLAYLIST_TRACK_FIELDS,
             },
         )
-        tracks = []
-        for item in data["items"]:
-            try:
-                img_url = item["track"]["album"]["images"][0]["url"]
-            except IndexError:
-                img_url = None
-            track = PlaylistTrack(
-                added_at=item["added_at"],
-                added_by=item["added_by"]["id"],
-                id=item["track"]["id"],
-                name=item["track"]["name"],
-                artists=[
-                    Artist(id=artist["id"], name=artist["name"], uri=artist["uri"])
-                    for artist in item["track"]["artists"]
-                ],
-                album=Album(
-                    id=item["track"]["album"]["id"],
-                    name=item["track"]["album"]["name"],
-                    artists=[
-                        Artist(id=artist["id"], name=artist["name"], uri=artist["uri"])
-                        for artist in item["track"]["album"]["artists"]
-                    ],
-                    image=img_url,
-                    uri=item["track"]["album"]["uri"],
-                ),
-                duration_ms=item["track"]["duration_ms"],
-                popularity=item["track"]["popularity"],
-                explicit=item["track"]["explicit"],
-                uri=item["track"]["uri"],
-            )
-            tracks.append(track)
-        return tracks
+        # Local files and removed tracks come back without a track object.
+        return [
+            self.catalog.intern_parts(PlaylistTrack.from_item(item))
+            for item in data["items"]
+            if item["track"]
+        ]
 
     async def get_top_tracks(
         self, user: User, type: str = "short_term", offset: int = 0, limit: int = 20
     ) -> List[Track]:
-        url = f"https://api.spotify.com/v1/me/top/tracks"
+        url = f"{self.api_url}/v1/me/top/tracks"
         data = await self.request(
             "GET",
             url,
-            headers={
-                "Authorization": f"Bearer {user.access_token}",
-            },
+            user=user,
+            cache_ttl=self.CACHE_TTLS["top"],
             params={
                 "time_range": type,
                 "offset": offset,
                 "limit": limit,
             },
         )
-        tracks = []
-        for item in data["items"]:
-            try:
-                img_url = item["album"]["images"][0]["url"]
-            except IndexError:
-                img_url = None
-            track = Track(
-                id=item["id"],
-                name=item["name"],
-                artists=[
-                    Artist(id=artist["id"], name=artist["name"], uri=artist["uri"])
-                    for artist in item["artists"]
-                ],
-                album=Album(
-                    id=item["album"]["id"],
-                    name=item["album"]["name"],
-                    artists=[
-                        Artist(id=artist["id"], name=artist["name"], uri=artist["uri"])
-                        for artist in item["album"]["artists"]
-                    ],
-                    image=img_url,
-                    uri=item["album"]["uri"],
-                ),
-                duration_ms=item["duration_ms"],
-                popularity=item["popularity"],
-                explicit=item["explicit"],
-                uri=item["uri"],
-            )
-            tracks.append(track)
-        return tracks
+        return [
+            self.catalog.intern_track(Track.from_json(item)) for item in data["items"]
+        ]
 
     async def get_top_artists(
         self, user: User, type: str = "short_term", offset: int = 0, limit: int = 20
     ) -> List[Artist]:
-        url = f"https://api.spotify.com/v1/me/top/artists"
+        url = f"{self.api_url}/v1/me/top/artists"
         data = await self.request(
             "GET",
             url,
-            headers={
-                "Authorization": f"Bearer {user.access_token}",
-            },
+            user=user,
+            cache_ttl=self.CACHE_TTLS["top"],
             params={
                 "time_range": type,
                 "offset": offset,
                 "limit": limit,
             },
         )
-        artists = []
-        for item in data["items"]:
-            try:
-                img_url = item["images"][0]["url"]
-            except IndexError:
-                img_url = None
-            artist = Artist(
-                id=item["id"],
-                name=item["name"],
-                uri=item["uri"],
-                image=img_url,
-                popularity=item["popularity"],
-                followers=item["followers"]["total"],
-                genres=item["genres"],
-            )
-            artists.append(artist)
-        return artists
+        return [
+            self.catalog.intern_artist(Artist.from_json(item)) for item in data["items"]
+        ]
 
     async def get_track(self, user: User, track_id: str) -> Track:
-        url = f"https://api.spotify.com/v1/tracks/{track_id}"
-        data = await self.request(
-            "GET",
-            url,
-            headers={
-                "Authorization": f"Bearer {user.access_token}",
-            },
-        )
-        try:
-            img_url = data["album"]["images"][0]["url"]
-        except IndexError:
-            img_url = None
-        track = Track(
-            id=data["id"],
-            name=data["name"],
-            artists=[
-                Artist(id=artist["id"], name=artist["name"], uri=artist["uri"])
-                for artist in data["artists"]
-            ],
-            album=Album(
-                id=data["album"]["id"],
-                name=data["album"]["name"],
-                artists=[
-                    Artist(id=artist["id"], name=artist["name"], uri=artist["uri"])
-                    for artist in data["album"]["artists"]
-                ],
-                image=img_url,
-                uri=data["album"]["uri"],
-            ),
-            duration_ms=data["duration_ms"],
-            popularity=data["popularity"],
-            explicit=data["explicit"],
-            uri=data["uri"],
-        )
+        (track,) = await self.catalog.get_tracks(user, [track_id])
+        if track is None:
+            raise HTTPError(404, f"Track {track_id} not found")
         return track
 
+    async def get_artists(self, user: User, artist_ids: List[str]) -> List[Artist]:
+        """Full artists from the catalog. Unknown ids are left out."""
+        artists = await self.catalog.get_artists(user, artist_ids)
+        return [artist for artist in artists if artist is not None]
+
+    async def get_several(
+        self, user: User, type: str, ids: List[str]
+    ) -> List[Dict[str, Any] | None]:
+        """Raw ``tracks`` or ``artists`` for up to 50 ids, ``None`` if unknown.
+
+        Not cached here; ``HTTP.catalog`` keeps the results.
+        """
+        url = f"{self.api_url}/v1/{type}"
+        data = await self.request("GET", url, user=user, params={"ids": ",".join(ids)})
+        return data[type]
+
+    async def get_recently_played(
+        self, user: User, after: int | None = None, limit: int = 50
+    ) -> List[Tuple[str, Track]]:
+        """Return ``(played_at, track)`` pairs played after ``after`` (Unix ms)."""
+        url = f"{self.api_url}/v1/me/player/recently-played"
+        params = {"limit": limit}
+        if after is not None:
+            params["after"] = after
+        data = await self.request("GET", url, user=user, params=params)
+        return [
+            (
+                item["played_at"],
+                self.catalog.intern_track(Track.from_json(item["track"])),
+            )
+            for item in data["items"]
+        ]
+
     async def close(self):
         if self.session:
             await self.session.close()
+        self._auth_executor.shutdown(wait=False)
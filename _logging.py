@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Tuple
+import atexit
+import datetime
+import json
+import logging
+import queue
+import re
+import sys
+import time
+import uuid
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+# Request ids passed in by a proxy are only kept if they look like one.
+_VALID_REQUEST_ID = re.compile(r"[\w.-]{1,64}")
+
+# Loggers the server configures with handlers of its own.
+SERVER_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+
+class _Handler(QueueHandler):
+    """Hands records to the listener thread, keeping their fields apart."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through ``burst`` records per call site every ``interval`` seconds.
+
+    Warnings, errors and records of the ``exempt`` loggers (and their
+    children) always pass. The first record after a dropped run carries the
+    number of records dropped in ``record.sampled``.
+    """
+
+    def __init__(
+        self, burst: int = 10, interval: float = 60, exempt: Tuple[str, ...] = ()
+    ):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.exempt = exempt
+        # Call site -> window start, records in window, records dropped.
+        self._sites: Dict[Tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self._exempt(record.name):
+            return True
+        now = time.monotonic()
+        site = self._sites.get((record.pathname, record.lineno))
+        if site is None or now - site[0] >= self.interval:
+            dropped = site[2] if site else 0
+            site = self._sites[(record.pathname, record.lineno)] = [now, 0, dropped]
+        if site[1] >= self.burst:
+            site[2] += 1
+            return False
+        site[1] += 1
+        if site[2]:
+            record.sampled = site[2]
+            site[2] = 0
+        return True
+
+    def _exempt(self, name: str) -> bool:
+        return any(name == e or name.startswith(f"{e}.") for e in self.exempt)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        text = super().formatMessage(record)
+        if getattr(record, "request_id", None):
+            text = f"{text} [{record.request_id}]"
+        if getattr(record, "sampled", 0):
+            text = f"{text} ({record.sampled} similar dropped)"
+        return text
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ("request_id", "sampled"):
+            if getattr(record, field, None):
+                data[field] = getattr(record, field)
+        if record.exc_text:
+            data["exc_info"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+def setup(
+    level: str = "INFO",
+    levels: str = "",
+    format: str = "text",
+    sample_burst: int = 10,
+    sample_interval: float = 60,
+) -> QueueListener:
+    """Log through a queue, so records are written on a background thread.
+
+    ``levels`` sets the level of single loggers, as in
+    ``tortoise=WARNING,aiohttp.access=ERROR``. ``format`` is ``text`` or
+    ``json``. A ``sample_burst`` of 0 turns sampling off. The server's
+    own loggers lose their handlers and go through the queue too, unsampled.
+    The listener is stopped at exit, which writes out whatever is still
+    queued.
+    """
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter() if format == "json" else TextFormatter())
+
+    records = queue.SimpleQueue()
+    handler = _Handler(records)
+    handler.addFilter(RequestIdFilter())
+    if sample_burst > 0:
+        # Every access log line comes from one call site.
+        handler.addFilter(
+            SamplingFilter(sample_burst, sample_interval, exempt=SERVER_LOGGERS)
+        )
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name in SERVER_LOGGERS:
+        logger = logging.getLogger(name)
+        for old in logger.handlers[:]:
+            logger.removeHandler(old)
+        logger.propagate = True
+    for item in levels.split(","):
+        name, _, logger_level = item.partition("=")
+        if name.strip() and logger_level.strip():
+            logging.getLogger(name.strip()).setLevel(logger_level.strip().upper())
+
+    listener = QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class RequestIdMiddleware:
+    """Gives every request an id, for its log records and its response.
+
+    An ``X-Request-ID`` header set by a proxy is reused.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        rid = incoming if _VALID_REQUEST_ID.fullmatch(incoming) else uuid.uuid4().hex
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Request-ID"] = rid
+            await send(message)
+
+        token = request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
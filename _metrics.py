@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+import abc
+import asyncio
+import logging
+import math
+import re
+import time
+import urllib.parse
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast cache hit to a slow Spotify call.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics: List["Metric"] = []
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    # Exact, so large counters still show small increments.
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+class Metric(abc.ABC):
+    """A metric in the Prometheus text format, registered when created."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[Any, ...]:
+        return tuple(labels[name] for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """Suffix, rendered labels and value of every sample."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_number(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, value in self._values.items():
+            yield "_total", _labels(self.labels, key), value
+
+
+class Gauge(Metric):
+    """A value that is set, or read from ``read`` when scraped.
+
+    ``read`` returns a number, or for a labelled gauge a mapping from label
+    value tuples to numbers.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        read: Callable[[], Any] | None = None,
+    ):
+        super().__init__(name, help, labels)
+        self.read = read
+        self._values: Dict[Tuple[Any, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        values = self._values
+        if self.read is not None:
+            try:
+                values = self.read()
+            except Exception as e:
+                logger.warning(f"Reading {self.name} failed: {e}")
+                return
+            if not isinstance(values, dict):
+                values = {(): values}
+        for key, value in values.items():
+            if isinstance(value, (int, float)):
+                yield "", _labels(self.labels, key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label set: a count per bucket, then the sum and the count.
+        self._values: Dict[Tuple[Any, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        names = self.labels + ("le",)
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", _labels(names, key + (bound,)), cumulative
+            yield "_bucket", _labels(names, key + ("+Inf",)), counts[-1]
+            yield "_sum", _labels(self.labels, key), counts[-2]
+            yield "_count", _labels(self.labels, key), counts[-1]
+
+
+def render() -> str:
+    """Every metric, in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+UPSTREAM_LATENCY = Histogram(
+    "unwrapped_spotify_request_seconds",
+    "Spotify API requests by endpoint and status.",
+    ("method", "endpoint", "status"),
+)
+RATE_LIMITED = Counter(
+    "unwrapped_spotify_rate_limited",
+    "429 responses from Spotify by endpoint.",
+    ("endpoint",),
+)
+RETRY_AFTER = Counter(
+    "unwrapped_spotify_retry_after_seconds",
+    "Retry-After seconds asked for by 429 responses.",
+)
+SLOT_WAIT = Histogram(
+    "unwrapped_spotify_slot_wait_seconds",
+    "Time a Spotify request waited for a per-user and a global slot.",
+)
+DB_QUERY = Histogram(
+    "unwrapped_db_query_seconds", "Database queries by query.", ("query",)
+)
+LOOP_LAG = Histogram(
+    "unwrapped_event_loop_lag_seconds",
+    "How late the event loop ran a timer.",
+)
+ROUTE_LATENCY = Histogram(
+    "unwrapped_request_seconds",
+    "Requests to the app by route, method and status.",
+    ("route", "method", "status"),
+)
+
+_SPOTIFY_ID = re.compile(r"/(playlists|tracks|artists|albums|users)/[^/]+")
+
+
+def endpoint(url: str) -> str:
+    """The path of a Spotify URL with ids replaced, as a label."""
+    return _SPOTIFY_ID.sub(r"/\1/{id}", urllib.parse.urlsplit(url).path)
+
+
+def stats(name: str, help: str, read: Callable[[], Dict[str, Any]]) -> Gauge:
+    """Expose the numbers in a ``stats()`` dict as ``<name>{stat=...}``."""
+    return Gauge(name, help, ("stat",), lambda: {(k,): v for k, v in read().items()})
+
+
+class LoopLagMonitor:
+    """Measures event loop lag by how late a repeating timer fires."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - start - self.interval)
+            LOOP_LAG.observe(self.lag)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class MetricsMiddleware:
+    """Records the latency of every request by route template and status."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes: Dict[Any, str] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            ROUTE_LATENCY.observe(
+                time.perf_counter() - start,
+                route=self._route(scope),
+                method=scope["method"],
+                status=status,
+            )
+
+    def _route(self, scope: Scope) -> str:
+        # The router leaves the matched endpoint in the scope.
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        route = self._routes.get(endpoint)
+        if route is None:
+            for candidate in scope["app"].routes:
+                if getattr(candidate, "endpoint", None) is endpoint:
+                    route = candidate.path
+                    break
+            else:
+                route = "unmatched"
+            self._routes[endpoint] = route
+        return route
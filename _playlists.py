@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Dict, List, Tuple, TYPE_CHECKING
+import asyncio
+
+from models import Playlist, PlaylistTrack, User
+
+if TYPE_CHECKING:
+    from _http import HTTP
+
+
+class PlaylistStore:
+    """Holds the full, sorted track list of each playlist version.
+
+    Entries are keyed by ``(playlist_id, snapshot_id)``, so a playlist is
+    fetched from Spotify once per version no matter how many visitors page
+    through it. Seeing a new ``snapshot_id`` drops the old version.
+    """
+
+    PAGE_SIZE = 100
+
+    def __init__(self, http: HTTP, max_tracks: int = 200_000, concurrency: int = 4):
+        self.http = http
+        self.max_tracks = max_tracks
+        self.concurrency = concurrency
+        self.size = 0
+
+        self._entries: OrderedDict[Tuple[str, str], Tuple[PlaylistTrack, ...]] = (
+            OrderedDict()
+        )
+        self._snapshots: Dict[str, str] = {}
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    async def get_tracks(
+        self, user: User, playlist: Playlist
+    ) -> Tuple[PlaylistTrack, ...]:
+        key = (playlist.id, playlist.snapshot_id)
+        try:
+            tracks = self._entries[key]
+        except KeyError:
+            pass
+        else:
+            self._entries.move_to_end(key)
+            return tracks
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(user, playlist))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def get_page(
+        self, user: User, playlist: Playlist, offset: int = 0, limit: int = 20
+    ) -> List[PlaylistTrack]:
+        tracks = await self.get_tracks(user, playlist)
+        return list(tracks[offset : offset + limit])
+
+    def invalidate(self, playlist_id: str) -> None:
+        snapshot_id = self._snapshots.pop(playlist_id, None)
+        if snapshot_id is not None:
+            self._remove((playlist_id, snapshot_id))
+
+    async def _load(
+        self, user: User, playlist: Playlist
+    ) -> Tuple[PlaylistTrack, ...]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(offset: int) -> List[PlaylistTrack]:
+            async with semaphore:
+                return await self.http.get_playlist_tracks(
+                    user,
+                    playlist.id,
+                    limit=self.PAGE_SIZE,
+                    offset=offset,
+                    cache=False,
+                )
+
+        pages = await asyncio.gather(
+            *[
+                fetch(offset)
+                for offset in range(0, max(playlist.track_count, 1), self.PAGE_SIZE)
+            ]
+        )
+        tracks = [track for page in pages for track in page]
+        # added_at is an ISO 8601 timestamp, so it sorts correctly as a string.
+        tracks.sort(key=lambda x: x.added_at or "", reverse=True)
+        tracks = tuple(tracks)
+
+        self.invalidate(playlist.id)
+        self._snapshots[playlist.id] = playlist.snapshot_id
+        self._entries[(playlist.id, playlist.snapshot_id)] = tracks
+        self.size += len(tracks)
+        while self.size > self.max_tracks and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+        return tracks
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        tracks = self._entries.pop(key, None)
+        if tracks is None:
+            return
+        self.size -= len(tracks)
+        if self._snapshots.get(key[0]) == key[1]:
+            del self._snapshots[key[0]]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "playlists": len(self._entries),
+            "tracks": self.size,
+            "max_tracks": self.max_tracks,
+        }
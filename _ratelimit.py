@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from typing import Any, Dict
+import asyncio
+import random
+
+from _backend import Backend
+
+
+class RateLimiter:
+    """App-wide limit on requests to Spotify.
+
+    Tokens come from a bucket in the shared backend, so every worker draws
+    from the same budget. The refill rate adapts: each 429 halves it and
+    blocks the bucket for ``Retry-After`` seconds, and each successful
+    request raises it a little until it is back at ``max_rate``.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        max_rate: float,
+        burst: float,
+        *,
+        min_rate: float = 1,
+        increase: float = 1,
+        name: str = "spotify",
+    ):
+        self.backend = backend
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.name = name
+
+        self.queued = 0
+        self.in_flight = 0
+        self.throttled = 0
+        self.retries = 0
+
+    async def acquire(self) -> None:
+        """Wait until a request may be sent. Holds no other resources."""
+        self.queued += 1
+        try:
+            while True:
+                wait = await self.backend.acquire(self.name, self.rate, self.burst)
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            self.queued -= 1
+
+    async def throttle(self, retry_after: float) -> None:
+        self.throttled += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        await self.backend.block(self.name, retry_after)
+
+    def success(self) -> None:
+        if self.rate < self.max_rate:
+            # Roughly ``increase`` requests/second more for every second of
+            # traffic without a 429.
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    @staticmethod
+    def backoff(attempt: int, base: float = 0.5, cap: float = 8) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(cap, base * 2**attempt))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "max_rate": self.max_rate,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "throttled": self.throttled,
+            "retries": self.retries,
+        }
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Dict, TYPE_CHECKING
+import asyncio
+import logging
+
+import jinja2
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from fastapi.templating import Jinja2Templates
+from markupsafe import Markup
+
+from models import dumps
+
+if TYPE_CHECKING:
+    from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+# Stands in for the first page while the template renders.
+_FIRST_PAGE = "\x00first_page\x00"
+
+
+class Renderer:
+    """Template environment and streamed page rendering.
+
+    Compiled templates are kept in a bytecode cache on disk and loaded once
+    at startup (:meth:`warm`), so no request pays for parsing. Pages whose
+    content is loaded by the browser can be rendered with :meth:`stream`:
+    the first page of data is fetched while the HTML up to ``first_page``
+    is already being sent, then inlined there, saving the browser its first
+    ``load_more_*`` round trip.
+    """
+
+    def __init__(
+        self,
+        directory: str = "templates",
+        *,
+        cache_dir: str | None = None,
+        auto_reload: bool = False,
+        inline_first_page: bool = True,
+    ):
+        self.inline_first_page = inline_first_page
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(directory),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+            auto_reload=auto_reload,
+            autoescape=True,
+        )
+        self.templates = Jinja2Templates(env=self.env)
+
+    def warm(self) -> int:
+        names = self.env.list_templates(extensions=["html"])
+        for name in names:
+            self.env.get_template(name)
+        return len(names)
+
+    def stream(
+        self,
+        request: Request,
+        name: str,
+        context: Dict[str, Any],
+        first_page: Callable[[], Awaitable[Any]] | None = None,
+    ) -> Response:
+        if first_page is None or not self.inline_first_page:
+            html = self.env.get_template(name).render(
+                request=request, first_page=Markup("null"), **context
+            )
+            return HTMLResponse(html)
+
+        task = asyncio.create_task(first_page())
+        # Retrieve errors here too, the body may never run if the client
+        # goes away first.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        html = self.env.get_template(name).render(
+            request=request, first_page=Markup(_FIRST_PAGE), **context
+        )
+        head, _, tail = html.partition(_FIRST_PAGE)
+
+        async def body():
+            try:
+                yield head
+                try:
+                    # No "<" at all, so nothing in the data can end the
+                    # script or open a comment in it.
+                    data = dumps(await task).decode().replace("<", "\\u003c")
+                except Exception as e:
+                    # The page loads it from the browser instead.
+                    logger.warning(f"Prefetching the first page of {name} failed: {e}")
+                    data = "null"
+                yield data + tail
+            finally:
+                if not task.done():
+                    task.cancel()
+
+        return StreamingResponse(body(), media_type="text/html")
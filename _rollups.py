@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Dict, Iterable, List, Sequence, Tuple
+import datetime
+
+from tortoise.expressions import Q
+from tortoise.functions import Sum
+
+from models import Play, PlayRollup, User
+
+KINDS = ("track", "artist", "album", "genre")
+
+# Rows per INSERT ... ON CONFLICT statement.
+UPSERT_CHUNK = 1000
+
+RollupKey = Tuple[int, str, datetime.date, str, str]
+
+
+def _month(day: datetime.date) -> datetime.date:
+    return day.replace(day=1)
+
+
+def _next_month(day: datetime.date) -> datetime.date:
+    if day.month == 12:
+        return datetime.date(day.year + 1, 1, 1)
+    return datetime.date(day.year, day.month + 1, 1)
+
+
+def _items(play: Play, genres: Sequence[str]) -> Iterable[Tuple[str, str]]:
+    yield "track", play.track_id
+    if play.album_id:
+        yield "album", play.album_id
+    for artist_id in play.artist_ids.split(","):
+        if artist_id:
+            yield "artist", artist_id
+    for genre in genres:
+        yield "genre", genre
+
+
+def tally(plays: Iterable[Tuple[Play, Sequence[str]]]) -> Dict[RollupKey, List[int]]:
+    """Sum ``(play, genres)`` pairs into ``[plays, ms_played]`` per rollup row."""
+    totals: Dict[RollupKey, List[int]] = defaultdict(lambda: [0, 0])
+    for play, genres in plays:
+        day = play.played_at.astimezone(datetime.timezone.utc).date()
+        for kind, item_id in _items(play, genres):
+            for period, bucket in (("day", day), ("month", _month(day))):
+                row = totals[play.user_id, period, bucket, kind, item_id]
+                row[0] += 1
+                row[1] += play.ms_played
+    return totals
+
+
+async def add_plays(plays: Iterable[Tuple[Play, Sequence[str]]], connection) -> None:
+    """Add newly stored plays to the rollups.
+
+    Each row is incremented in the database (``ON CONFLICT DO UPDATE``), so
+    workers writing plays at the same time can't lose each other's counts.
+    Both Postgres and SQLite accept the statement.
+    """
+    totals = tally(plays)
+    if not totals:
+        return
+    table = PlayRollup._meta.db_table
+    columns = ("user_id", "period", "bucket", "kind", "item_id", "plays", "ms_played")
+    if connection.capabilities.dialect == "postgres":
+        placeholders = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+    else:
+        placeholders = ", ".join("?" * len(columns))
+    query = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+        "ON CONFLICT (user_id, period, kind, bucket, item_id) DO UPDATE SET "
+        f"plays = {table}.plays + excluded.plays, "
+        f"ms_played = {table}.ms_played + excluded.ms_played"
+    )
+    rows = [[*key, count, ms] for key, (count, ms) in totals.items()]
+    for i in range(0, len(rows), UPSERT_CHUNK):
+        await connection.execute_many(query, rows[i : i + UPSERT_CHUNK])
+
+
+def buckets(start: datetime.date, end: datetime.date) -> Q:
+    """Filter for the fewest rollup rows that exactly cover ``[start, end)``.
+
+    Whole months in the range come from monthly rows and the days before
+    and after them from daily rows, so a query reads at most ~60 buckets
+    per item no matter how long the range is.
+    """
+    first_month = start if start.day == 1 else _next_month(start)
+    last_month = _month(end)
+    if first_month >= last_month:
+        return Q(period="day", bucket__gte=start, bucket__lt=end)
+    return (
+        Q(period="day", bucket__gte=start, bucket__lt=first_month)
+        | Q(period="month", bucket__gte=first_month, bucket__lt=last_month)
+        | Q(period="day", bucket__gte=last_month, bucket__lt=end)
+    )
+
+
+async def top_items(
+    user: User, kind: str, start: datetime.date, end: datetime.date, limit: int = 10
+) -> List[Dict[str, object]]:
+    rows = (
+        await PlayRollup.filter(buckets(start, end), user_id=user.id, kind=kind)
+        .annotate(count=Sum("plays"), ms=Sum("ms_played"))
+        .group_by("item_id")
+        .order_by("-count")
+        .limit(limit)
+        .values("item_id", "count", "ms")
+    )
+    return [
+        {"id": row["item_id"], "plays": row["count"], "ms_played": row["ms"]}
+        for row in rows
+    ]
+
+
+async def totals(
+    user: User, start: datetime.date, end: datetime.date
+) -> Tuple[int, int]:
+    """Plays and listening time in ``[start, end)``, from the track rows."""
+    row = (
+        await PlayRollup.filter(buckets(start, end), user_id=user.id, kind="track")
+        .annotate(count=Sum("plays"), ms=Sum("ms_played"))
+        .first()
+        .values("count", "ms")
+    )
+    if not row:
+        return 0, 0
+    return row["count"] or 0, row["ms"] or 0
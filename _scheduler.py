@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+from typing import Dict, List, Set, Tuple, TYPE_CHECKING
+import asyncio
+import datetime
+import heapq
+import logging
+import random
+
+import pytz
+import tortoise
+from tortoise.expressions import Q
+
+from _http import seconds_until
+from models import User
+
+if TYPE_CHECKING:
+    from _http import HTTP
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    """Refreshes access tokens of active users shortly before they expire.
+
+    All scheduled refreshes live in one heap ordered by due time and a single
+    worker pops them, running at most ``concurrency`` refreshes at once.
+    Users that haven't been seen for ``idle_after`` seconds are dropped after
+    their next refresh; their token is refreshed again when they come back.
+    """
+
+    def __init__(
+        self,
+        http: HTTP,
+        *,
+        concurrency: int = 8,
+        lead: float = 60,
+        idle_after: float = 6 * 60 * 60,
+        boot_jitter: float = 60,
+        retry_delay: float = 300,
+        chunk_size: int = 5000,
+    ):
+        self.http = http
+        self.concurrency = concurrency
+        # ensure_token only refreshes within its margin, so a longer lead
+        # would wake up to find nothing to do.
+        self.lead = min(lead, http.TOKEN_REFRESH_MARGIN)
+        self.idle_after = idle_after
+        self.boot_jitter = boot_jitter
+        self.retry_delay = retry_delay
+        self.chunk_size = chunk_size
+        self.refreshed = 0
+        self.failed = 0
+
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+        self._last_seen: Dict[int, float] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+        self._worker: asyncio.Task | None = None
+        self._loader: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    @property
+    def backlog(self) -> int:
+        """Number of scheduled refreshes that are already due."""
+        now = asyncio.get_running_loop().time()
+        return sum(1 for due in self._due.values() if due <= now)
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    async def start(self) -> None:
+        """Start refreshing. Users are loaded in the background."""
+        self._worker = asyncio.create_task(self._run())
+        self._loader = asyncio.create_task(self._load())
+
+    async def _load(self) -> None:
+        loop = asyncio.get_running_loop()
+        since = datetime.datetime.now(pytz.utc) - datetime.timedelta(
+            seconds=self.idle_after
+        )
+        # Tokens of inactive users stop being refreshed, so a recent expiry
+        # is a good enough sign of a user worth keeping warm. Walks the
+        # token_expires index in chunks instead of loading every user.
+        users = User.filter(token_expires__gte=since)
+        count = 0
+        last = None
+        try:
+            while True:
+                query = users
+                if last is not None:
+                    query = query.filter(
+                        Q(token_expires__gt=last[1])
+                        | Q(token_expires=last[1], id__gt=last[0])
+                    )
+                rows = (
+                    await query.order_by("token_expires", "id")
+                    .limit(self.chunk_size)
+                    .values_list("id", "token_expires")
+                )
+                now = loop.time()
+                for user_id, token_expires in rows:
+                    self._last_seen.setdefault(user_id, now)
+                    self.schedule(user_id, token_expires, jitter=self.boot_jitter)
+                count += len(rows)
+                if len(rows) < self.chunk_size:
+                    break
+                last = rows[-1]
+        except Exception as e:
+            logger.warning(f"Loading users for token refresh failed: {e}")
+        logger.info(f"Scheduled token refresh for {count} users")
+
+    async def close(self) -> None:
+        if self._loader:
+            self._loader.cancel()
+        if self._worker:
+            self._worker.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def schedule(
+        self, user_id: int, token_expires: datetime.datetime | None, jitter: float = 0
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        due = loop.time() + seconds_until(token_expires) - self.lead
+        if due <= loop.time() and jitter:
+            # Spread already expired tokens out instead of refreshing them
+            # all at once.
+            due = loop.time() + random.uniform(0, jitter)
+        current = self._due.get(user_id)
+        if current is not None and current <= due:
+            return
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+        self._wakeup.set()
+
+    def touch(self, user: User) -> None:
+        """Mark ``user`` as active, scheduling a refresh if none is pending."""
+        self._last_seen[user.id] = asyncio.get_running_loop().time()
+        if user.id not in self._due:
+            self.schedule(user.id, user.token_expires)
+
+    async def _run(self) -> None:
+        while True:
+            await self._slots.acquire()
+            try:
+                user_id = await self._next_due()
+            except BaseException:
+                self._slots.release()
+                raise
+            task = asyncio.create_task(self._refresh(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _next_due(self) -> int:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            while self._heap:
+                due, user_id = self._heap[0]
+                if self._due.get(user_id) != due:
+                    heapq.heappop(self._heap)
+                    continue
+                timeout = due - loop.time()
+                if timeout <= 0:
+                    heapq.heappop(self._heap)
+                    del self._due[user_id]
+                    return user_id
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refresh(self, user_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                user = await User.get(id=user_id)
+                # Not forced: a request by a returning user has usually
+                # refreshed the token already.
+                await self.http.ensure_token(user)
+            except tortoise.exceptions.DoesNotExist:
+                self._last_seen.pop(user_id, None)
+                return
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Token refresh for user {user_id} failed: {e}")
+                if self._is_active(user_id):
+                    self._due[user_id] = due = loop.time() + self.retry_delay
+                    heapq.heappush(self._heap, (due, user_id))
+                    self._wakeup.set()
+                return
+
+            self.refreshed += 1
+            if self._is_active(user_id):
+                self.schedule(user_id, user.token_expires)
+            else:
+                self._last_seen.pop(user_id, None)
+        finally:
+            self._slots.release()
+
+    def _is_active(self, user_id: int) -> bool:
+        last_seen = self._last_seen.get(user_id)
+        if last_seen is None:
+            return False
+        return asyncio.get_running_loop().time() - last_seen < self.idle_after
+
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List
+import secrets
+import time
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from _backend import Backend
+from models import User
+
+
+class SessionTokens:
+    """Signed session tokens that carry the user instead of pointing to it.
+
+    A token holds the user id (``uid``) and a random session id (``sid``),
+    so a request can be authorized without looking anything up in the
+    database. Its lifetime is ``max_age``, checked against the signed
+    timestamp. Tokens are signed with the last of ``secret_keys`` and
+    accepted with any of them, which lets keys be rotated without logging
+    everyone out. Tokens older than ``rotate_after`` seconds should be
+    reissued (see :meth:`stale`), and logging out puts the session id on a
+    revocation list in the shared backend until the token would have
+    expired anyway.
+    """
+
+    def __init__(
+        self,
+        secret_keys: List[str],
+        salt: str,
+        backend: Backend,
+        *,
+        max_age: float = 30 * 24 * 60 * 60,
+        rotate_after: float = 24 * 60 * 60,
+    ):
+        self.backend = backend
+        self.max_age = max_age
+        self.rotate_after = rotate_after
+        self._serializer = URLSafeTimedSerializer(secret_keys, salt=salt)
+
+    def issue(self, user: User, sid: str | None = None) -> str:
+        return self._serializer.dumps(
+            {
+                "uid": user.id,
+                "sid": sid or secrets.token_urlsafe(16),
+            }
+        )
+
+    async def verify(self, token: str | None) -> Dict[str, Any] | None:
+        """Return the claims of ``token``, or ``None`` if it isn't valid."""
+        if not token:
+            return None
+        try:
+            claims, signed_at = self._serializer.loads(
+                token, max_age=self.max_age, return_timestamp=True
+            )
+        except BadSignature:
+            return None
+        if await self.backend.get("revoked", claims["sid"]):
+            return None
+        claims["iat"] = signed_at.timestamp()
+        return claims
+
+    def stale(self, claims: Dict[str, Any]) -> bool:
+        return time.time() - claims["iat"] > self.rotate_after
+
+    async def revoke(self, claims: Dict[str, Any]) -> None:
+        await self.backend.set("revoked", claims["sid"], True, self.max_age)
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List
+import asyncio
+import functools
+import time
+
+import cachetools
+import tortoise
+
+import _metrics
+from _backend import Backend
+from models import User
+
+
+class UserCache:
+    """Users by session key or id, in two tiers.
+
+    The first tier is an in-process LRU holding rows for ``ttl`` seconds, the
+    second the shared backend (``shared_ttl``), so a user loaded by one
+    worker is a cache hit for the others. Misses for the same key share one
+    query. Whatever changes a user writes it through with :meth:`put`, so
+    rotated tokens are never served from a stale entry in this worker.
+    Unknown keys can be remembered for ``negative_ttl`` seconds.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        *,
+        max_size: int = 10_000,
+        ttl: float = 30,
+        shared_ttl: float = 300,
+        negative_ttl: float = 0,
+    ):
+        self.backend = backend
+        self.shared_ttl = shared_ttl
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+
+        self._local = cachetools.TTLCache(maxsize=max_size, ttl=ttl)
+        self._unknown = (
+            cachetools.TTLCache(maxsize=max_size, ttl=negative_ttl)
+            if negative_ttl > 0
+            else None
+        )
+        self._loading: Dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str) -> User | None:
+        """Return the user with session key ``key``, or ``None``."""
+        return await self._get("key", key)
+
+    async def get_by_id(self, user_id: int) -> User | None:
+        return await self._get("id", user_id)
+
+    async def _get(self, field: str, value: Any) -> User | None:
+        key = f"{field}:{value}"
+        data = self._local.get(key)
+        if data is not None:
+            self.local_hits += 1
+            return User.from_cache(data)
+        if self._unknown is not None and key in self._unknown:
+            self.negative_hits += 1
+            return None
+
+        task = self._loading.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.create_task(self._load(key, field, value))
+            self._loading[key] = task
+            task.add_done_callback(functools.partial(self._loaded, key))
+        data = await asyncio.shield(task)
+        return User.from_cache(data) if data is not None else None
+
+    def _loaded(self, key: str, task: asyncio.Task) -> None:
+        if self._loading.get(key) is task:
+            del self._loading[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def _load(self, key: str, field: str, value: Any) -> Dict[str, Any] | None:
+        data = await self.backend.get("user", key)
+        if data is not None:
+            self.shared_hits += 1
+            self._local[key] = data
+            return data
+
+        self.misses += 1
+        start = time.perf_counter()
+        try:
+            user = await User.get(**{field: value})
+        except tortoise.exceptions.DoesNotExist:
+            if self._unknown is not None:
+                self._unknown[key] = True
+            return None
+        finally:
+            _metrics.DB_QUERY.observe(
+                time.perf_counter() - start, query=f"user_by_{field}"
+            )
+        await self.put(user)
+        return user.to_cache()
+
+    async def put(self, user: User) -> None:
+        """Store the current state of ``user`` in both tiers."""
+        data = user.to_cache()
+        for key in self._keys(user):
+            self._local[key] = data
+            if self._unknown is not None:
+                self._unknown.pop(key, None)
+            await self.backend.set("user", key, data, self.shared_ttl)
+
+    async def invalidate(self, user: User) -> None:
+        for key in self._keys(user):
+            self._local.pop(key, None)
+            await self.backend.pop("user", key)
+
+    @staticmethod
+    def _keys(user: User) -> List[str]:
+        keys = [f"id:{user.id}"]
+        if user.key:
+            keys.append(f"key:{user.key}")
+        return keys
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = (
+            self.local_hits
+            + self.shared_hits
+            + self.negative_hits
+            + self.coalesced
+            + self.misses
+        )
+        return {
+            "size": len(self._local),
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "coalesced": self.coalesced,
+            "hit_ratio": (lookups - self.misses) / lookups if lookups else 0,
+        }
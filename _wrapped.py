@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from collections import Counter
+from itertools import chain
+from typing import Any, Dict, List, TYPE_CHECKING
+import asyncio
+import datetime
+
+import pytz
+
+from models import Artist, Track, User
+
+if TYPE_CHECKING:
+    from _http import HTTP
+
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+
+# Spotify's largest page for the top items endpoints.
+TOP_LIMIT = 50
+
+CACHE_TTL = 24 * 60 * 60
+
+
+async def get_wrapped(http: HTTP, user: User) -> Dict[str, Any]:
+    """Return the Wrapped stats of ``user``, computed at most once a day."""
+    key = f"{user.id}:{datetime.datetime.now(pytz.utc).date()}"
+    stats = await http.client.backend.get("wrapped", key)
+    if stats is None:
+        stats = await build_wrapped(http, user)
+        await http.client.backend.set("wrapped", key, stats, CACHE_TTL)
+    return stats
+
+
+async def build_wrapped(http: HTTP, user: User) -> Dict[str, Any]:
+    results = await asyncio.gather(
+        *[
+            http.get_top_tracks(user, type=time_range, limit=TOP_LIMIT)
+            for time_range in TIME_RANGES
+        ],
+        *[
+            http.get_top_artists(user, type=time_range, limit=TOP_LIMIT)
+            for time_range in TIME_RANGES
+        ],
+    )
+    tracks = dict(zip(TIME_RANGES, results[: len(TIME_RANGES)]))
+    artists = dict(zip(TIME_RANGES, results[len(TIME_RANGES) :]))
+
+    stats = {
+        "terms": {
+            time_range: term_stats(tracks[time_range], artists[time_range])
+            for time_range in TIME_RANGES
+        },
+        "changes": {},
+    }
+    for newer, older in zip(TIME_RANGES, TIME_RANGES[1:]):
+        stats["changes"][f"{newer}:{older}"] = {
+            "tracks": _compare(
+                [t.id for t in tracks[newer]], [t.id for t in tracks[older]]
+            ),
+            "artists": _compare(
+                [a.id for a in artists[newer]], [a.id for a in artists[older]]
+            ),
+        }
+    return stats
+
+
+def term_stats(tracks: List[Track], artists: List[Artist]) -> Dict[str, Any]:
+    """Aggregate one time range."""
+    count = len(tracks)
+
+    artist_counts = Counter(
+        chain.from_iterable((a.id for a in t.artists) for t in tracks)
+    )
+    artist_names = {a.id: a.name for t in tracks for a in t.artists}
+    genre_counts = Counter(chain.from_iterable(a.genres or () for a in artists))
+    genre_total = sum(genre_counts.values())
+
+    return {
+        "track_count": count,
+        "artist_count": len(artist_counts),
+        "avg_popularity": sum(t.popularity for t in tracks) / count if count else 0,
+        "avg_duration_ms": sum(t.duration_ms for t in tracks) / count if count else 0,
+        "explicit_ratio": sum(t.explicit for t in tracks) / count if count else 0,
+        "artist_share": [
+            {"id": id, "name": artist_names[id], "share": n / count}
+            for id, n in artist_counts.most_common(10)
+        ],
+        "genres": [
+            {"name": genre, "share": n / genre_total}
+            for genre, n in genre_counts.most_common(10)
+        ],
+        "top_tracks": [
+            {
+                "id": t.id,
+                "name": t.name,
+                "artists": ", ".join(a.name for a in t.artists),
+                "image": t.album.image,
+            }
+            for t in tracks[:5]
+        ],
+        "top_artists": [
+            {"id": a.id, "name": a.name, "image": a.image} for a in artists[:5]
+        ],
+    }
+
+
+def _compare(newer: List[str], older: List[str]) -> Dict[str, float]:
+    """Overlap (Jaccard) and churn (share of ``newer`` not in ``older``)."""
+    newer_set, older_set = set(newer), set(older)
+    union = newer_set | older_set
+    shared = newer_set & older_set
+    return {
+        "overlap": len(shared) / len(union) if union else 0,
+        "churn": 1 - len(shared) / len(newer_set) if newer_set else 0,
+    }
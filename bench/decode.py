@@ -0,0 +1,93 @@
+"""Benchmark decoding a 100-item playlist page into the models.
+
+Usage: python -m bench.decode [iterations]
+
+Compares the stdlib ``json`` decoder with ``models.loads`` and measures the
+memory held by the mapped tracks, both as the slotted models and as
+equivalent regular (``__dict__``-backed) dataclasses.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+import dataclasses
+import json
+import sys
+import time
+import tracemalloc
+
+import models
+from models import PlaylistTrack
+
+FIXTURE = Path(__file__).parent / "fixtures" / "playlist_tracks.json"
+
+_unslotted_classes = {}
+
+
+def _unslotted(obj):
+    """Rebuild ``obj`` with regular dataclasses in place of the slotted ones."""
+    if isinstance(obj, list):
+        return [_unslotted(item) for item in obj]
+    if not dataclasses.is_dataclass(obj):
+        return obj
+    cls = type(obj)
+    if cls not in _unslotted_classes:
+        _unslotted_classes[cls] = dataclasses.make_dataclass(
+            cls.__name__, [(f.name, f.type) for f in dataclasses.fields(cls)]
+        )
+    return _unslotted_classes[cls](
+        **{f.name: _unslotted(getattr(obj, f.name)) for f in dataclasses.fields(obj)}
+    )
+
+
+def _time(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def _retained(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def main(iterations: int = 200) -> None:
+    body = FIXTURE.read_bytes()
+    text = body.decode()
+
+    def decode_stdlib():
+        data = json.loads(text)
+        return [PlaylistTrack.from_item(item) for item in data["items"]]
+
+    def decode_fast():
+        data = models.loads(body)
+        return [PlaylistTrack.from_item(item) for item in data["items"]]
+
+    tracks = decode_fast()
+    count = len(tracks)
+    print(f"fixture: {len(body) / 1024:.0f} KiB, {count} items")
+    print(f"encoder: {'orjson' if models.orjson else 'json (orjson not installed)'}")
+    print(f"json.loads + map:   {_time(decode_stdlib, iterations):7.3f} ms/page")
+    print(f"models.loads + map: {_time(decode_fast, iterations):7.3f} ms/page")
+
+    data = models.loads(body)
+    slotted = _retained(
+        lambda: [PlaylistTrack.from_item(item) for item in data["items"]]
+    )
+    regular = _retained(
+        lambda: _unslotted(
+            [PlaylistTrack.from_item(item) for item in data["items"]]
+        )
+    )
+    print(f"regular dataclasses: {regular / count:7.0f} bytes/track")
+    print(f"slotted dataclasses: {slotted / count:7.0f} bytes/track")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,312 @@
+"""A local stand-in for the Spotify accounts service and Web API.
+
+Usage: python -m bench.fake_spotify [--port 8900] [--latency MS] [--jitter MS]
+                                    [--rate-limit FRACTION] [--retry-after SECONDS]
+
+Point the app at it with ``SPOTIFY_API_URL`` and ``SPOTIFY_ACCOUNTS_URL``.
+Responses are built from the recorded playlist page in ``fixtures/``: its
+tracks fill every playlist and top track list, and their artists the top
+artists. Every authorization code is a user of its own. ``--rate-limit``
+answers that fraction of requests with a 429. ``GET /_calls`` returns the
+number of requests per endpoint and ``DELETE /_calls`` resets it.
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List
+import argparse
+import asyncio
+import datetime
+import json
+import random
+
+from aiohttp import web
+from yarl import URL
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+PLAYLISTS = 50
+PLAYLIST_TRACKS = 250
+GENRES = ["pop", "rock", "indie", "hip hop", "jazz", "electronic", "folk"]
+
+
+def _error(status: int, message: str) -> web.Response:
+    return web.json_response(
+        {"error": {"status": status, "message": message}}, status=status
+    )
+
+
+class FakeSpotify:
+    def __init__(
+        self,
+        fixtures: Path = FIXTURES,
+        *,
+        latency: float = 0,
+        jitter: float = 0,
+        rate_limit: float = 0,
+        retry_after: int = 1,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self._random = random.Random(seed)
+        # Encoded responses by path and query; they don't depend on the user.
+        self._bodies: Dict[str, bytes] = {}
+
+        page = json.loads((fixtures / "playlist_tracks.json").read_text())
+        self.items: List[Dict[str, Any]] = page["items"]
+        self.tracks = {item["track"]["id"]: item["track"] for item in self.items}
+        self.artists: Dict[str, Dict[str, Any]] = {}
+        for track in self.tracks.values():
+            for artist in track["artists"]:
+                if artist["id"] not in self.artists:
+                    self.artists[artist["id"]] = self._full_artist(artist)
+
+    def _full_artist(self, artist: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            **artist,
+            "followers": {"href": None, "total": self._random.randrange(100_000)},
+            "genres": self._random.sample(GENRES, 2),
+            "images": [{"url": f"https://i.scdn.co/image/{artist['id']}"}],
+            "popularity": self._random.randrange(100),
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.add_routes(
+            [
+                web.get("/_calls", self.get_calls),
+                web.delete("/_calls", self.reset_calls),
+                web.get("/authorize", self.authorize),
+                web.post("/api/token", self.token),
+                web.get("/v1/me", self.me),
+                web.get("/v1/me/playlists", self.my_playlists),
+                web.get("/v1/me/top/tracks", self.top_tracks),
+                web.get("/v1/me/top/artists", self.top_artists),
+                web.get("/v1/me/player/recently-played", self.recently_played),
+                web.get("/v1/playlists/{id}", self.playlist),
+                web.get("/v1/playlists/{id}/tracks", self.playlist_tracks),
+                web.get("/v1/tracks", self.several),
+                web.get("/v1/tracks/{id}", self.track),
+                web.get("/v1/artists", self.several),
+            ]
+        )
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        if request.path.startswith("/_"):
+            return await handler(request)
+        resource = request.match_info.route.resource
+        endpoint = resource.canonical if resource else request.path
+        self.calls[f"{request.method} {endpoint}"] += 1
+
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.rate_limit and self._random.random() < self.rate_limit:
+            self.calls["429"] += 1
+            response = _error(429, "API rate limit exceeded")
+            response.headers["Retry-After"] = str(self.retry_after)
+            return response
+        if request.path.startswith("/v1/"):
+            auth = request.headers.get("Authorization", "")
+            if not auth.startswith("Bearer token-"):
+                return _error(401, "Invalid access token")
+        return await handler(request)
+
+    def _json(self, request: web.Request, build) -> web.Response:
+        body = self._bodies.get(request.path_qs)
+        if body is None:
+            body = self._bodies[request.path_qs] = json.dumps(build()).encode()
+        return web.Response(body=body, content_type="application/json")
+
+    async def get_calls(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.calls))
+
+    async def reset_calls(self, request: web.Request) -> web.Response:
+        self.calls.clear()
+        return web.json_response({})
+
+    async def authorize(self, request: web.Request) -> web.Response:
+        location = URL(request.query["redirect_uri"]).with_query(
+            code="bench", state=request.query.get("state", "")
+        )
+        raise web.HTTPFound(location)
+
+    async def token(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if form.get("grant_type") == "refresh_token":
+            user = str(form["refresh_token"]).removeprefix("refresh-")
+        else:
+            user = str(form["code"])
+        return web.json_response(
+            {
+                "access_token": f"token-{user}",
+                "token_type": "Bearer",
+                "expires_in": 3600,
+                "refresh_token": f"refresh-{user}",
+                "scope": "",
+            }
+        )
+
+    async def me(self, request: web.Request) -> web.Response:
+        user = request.headers["Authorization"].removeprefix("Bearer token-")
+        return web.json_response(
+            {
+                "id": user,
+                "display_name": user,
+                "email": f"{user}@example.com",
+                "uri": f"spotify:user:{user}",
+                "images": [{"url": f"https://i.scdn.co/image/{user}"}],
+                "country": "NL",
+                "product": "premium",
+            }
+        )
+
+    @staticmethod
+    def _page(request: web.Request, default: int, maximum: int) -> tuple:
+        offset = int(request.query.get("offset", 0))
+        limit = min(int(request.query.get("limit", default)), maximum)
+        return offset, limit
+
+    def _playlist(self, i: int) -> Dict[str, Any]:
+        href = f"https://api.spotify.com/v1/playlists/playlist{i}"
+        return {
+            "id": f"playlist{i}",
+            "name": f"Playlist {i}",
+            "description": "",
+            "collaborative": False,
+            "public": True,
+            "href": href,
+            "images": [{"url": f"https://i.scdn.co/image/playlist{i}"}],
+            "owner": {"id": "bench", "display_name": "Bench"},
+            "snapshot_id": f"snapshot{i}",
+            "tracks": {"href": f"{href}/tracks", "total": PLAYLIST_TRACKS},
+        }
+
+    async def my_playlists(self, request: web.Request) -> web.Response:
+        offset, limit = self._page(request, 20, 50)
+        return self._json(
+            request,
+            lambda: {
+                "items": [
+                    self._playlist(i)
+                    for i in range(offset, min(offset + limit, PLAYLISTS))
+                ],
+                "offset": offset,
+                "limit": limit,
+                "total": PLAYLISTS,
+            },
+        )
+
+    async def playlist(self, request: web.Request) -> web.Response:
+        playlist_id = request.match_info["id"]
+        if not playlist_id.removeprefix("playlist").isdigit():
+            return _error(404, "Not found.")
+        return self._json(
+            request, lambda: self._playlist(int(playlist_id.removeprefix("playlist")))
+        )
+
+    async def playlist_tracks(self, request: web.Request) -> web.Response:
+        offset, limit = self._page(request, 100, 100)
+        end = min(offset + limit, PLAYLIST_TRACKS)
+        return self._json(
+            request,
+            lambda: {
+                "items": [
+                    self.items[i % len(self.items)] for i in range(offset, end)
+                ],
+                "offset": offset,
+                "limit": limit,
+                "total": PLAYLIST_TRACKS,
+            },
+        )
+
+    async def top_tracks(self, request: web.Request) -> web.Response:
+        offset, limit = self._page(request, 20, 50)
+        tracks = list(self.tracks.values())
+        return self._json(
+            request,
+            lambda: {
+                "items": tracks[offset : offset + limit],
+                "offset": offset,
+                "limit": limit,
+                "total": len(tracks),
+            },
+        )
+
+    async def top_artists(self, request: web.Request) -> web.Response:
+        offset, limit = self._page(request, 20, 50)
+        artists = list(self.artists.values())
+        return self._json(
+            request,
+            lambda: {
+                "items": artists[offset : offset + limit],
+                "offset": offset,
+                "limit": limit,
+                "total": len(artists),
+            },
+        )
+
+    async def recently_played(self, request: web.Request) -> web.Response:
+        # One play every four minutes, the latest one a minute ago.
+        now = datetime.datetime.now(datetime.timezone.utc)
+        after = int(request.query.get("after", 0))
+        limit = min(int(request.query.get("limit", 20)), 50)
+        items = []
+        for i, track in enumerate(list(self.tracks.values())[:limit]):
+            played_at = now - datetime.timedelta(minutes=1 + 4 * i)
+            if played_at.timestamp() * 1000 <= after:
+                break
+            items.append(
+                {
+                    "played_at": played_at.isoformat().replace("+00:00", "Z"),
+                    "track": track,
+                }
+            )
+        return web.json_response({"items": items, "limit": limit})
+
+    async def track(self, request: web.Request) -> web.Response:
+        track = self.tracks.get(request.match_info["id"])
+        if track is None:
+            return _error(404, "Not found.")
+        return self._json(request, lambda: track)
+
+    async def several(self, request: web.Request) -> web.Response:
+        type = request.path.rsplit("/", 1)[1]
+        known = self.tracks if type == "tracks" else self.artists
+        ids = request.query.get("ids", "").split(",")
+        return self._json(request, lambda: {type: [known.get(id) for id in ids]})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="fraction of requests to 429"
+    )
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeSpotify(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
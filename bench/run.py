@@ -0,0 +1,312 @@
+"""Load test ``main.app`` against the fake Spotify API.
+
+Usage: python -m bench.run [--users 20] [--rounds 5] [--concurrency 20]
+                           [--latency MS] [--jitter MS] [--rate-limit FRACTION]
+                           [--json FILE]
+
+Starts ``bench.fake_spotify`` in a subprocess, points the app at it and at a
+fresh SQLite database, and logs ``--users`` users in through ``/login`` and
+``/callback``. Every user then requests each of ``ROUTES`` ``--rounds``
+times, ``--concurrency`` requests at a time. The app runs in this process
+and is called through ASGI without a server, so the numbers are for the
+app alone.
+
+Reports requests per second, p50/p95/p99 latency per route, Spotify calls
+per route for a new user and again once its caches are warm, and memory.
+``--json`` also writes the results to a file, to compare runs.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Dict, List
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import aiohttp
+import httpx
+
+ROOT = Path(__file__).parent.parent
+
+ROUTES = [
+    "/",
+    "/profile",
+    "/playlists",
+    "/load_more_playlists?page=1",
+    "/playlist?playlist_id=playlist0",
+    "/load_more_playlist_tracks?playlist_id=playlist0&page=1",
+    "/toptracks",
+    "/load_more_toptracks?page=1",
+    "/topartists",
+    "/load_more_topartists?page=1",
+    "/track?track_id={track_id}",
+    "/wrapped",
+    "/history_stats",
+    "/static/css/main.css",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _memory() -> Dict[str, float]:
+    """Current and peak resident memory of this process, in MiB."""
+    memory = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    memory[name] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return {
+        "rss": memory.get("VmRSS", 0.0),
+        "peak": memory.get("VmHWM", peak / 1024),
+    }
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Fake:
+    """``bench.fake_spotify`` running in a subprocess."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.url = f"http://127.0.0.1:{_free_port()}"
+        self.process = None
+        self.session = None
+
+    async def start(self) -> None:
+        port = self.url.rsplit(":", 1)[1]
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "bench.fake_spotify",
+            "--port",
+            port,
+            "--latency",
+            str(self.args.latency),
+            "--jitter",
+            str(self.args.jitter),
+            "--rate-limit",
+            str(self.args.rate_limit),
+            cwd=ROOT,
+        )
+        self.session = aiohttp.ClientSession()
+        for _ in range(100):
+            try:
+                await self.calls()
+                return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError("bench.fake_spotify didn't start")
+
+    async def calls(self) -> Dict[str, int]:
+        async with self.session.get(f"{self.url}/_calls") as response:
+            return await response.json()
+
+    async def reset(self) -> None:
+        async with self.session.delete(f"{self.url}/_calls"):
+            pass
+
+    async def stop(self) -> None:
+        if self.session:
+            await self.session.close()
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+
+async def login(transport: httpx.ASGITransport, name: str) -> httpx.AsyncClient:
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+    response = await client.get("/login")
+    query = urllib.parse.urlparse(response.headers["location"]).query
+    state = urllib.parse.parse_qs(query)["state"][0]
+    response = await client.get("/callback", params={"code": name, "state": state})
+    if response.status_code != 200 or "error" in response.text[:100]:
+        raise RuntimeError(f"Logging in {name} failed: {response.text[:200]}")
+    return client
+
+
+async def upstream_calls(fake: Fake, client, routes: List[str]) -> Dict[str, Any]:
+    """Spotify calls made by each route, one request at a time."""
+    calls = {}
+    for route in routes:
+        await fake.reset()
+        await client.get(route)
+        counts = await fake.calls()
+        calls[route] = sum(n for name, n in counts.items() if name != "429")
+    return calls
+
+
+async def load(clients: list, routes: List[str], rounds: int, concurrency: int):
+    jobs = asyncio.Queue()
+    for _ in range(rounds):
+        for client in clients:
+            for route in routes:
+                jobs.put_nowait((client, route))
+    timings: Dict[str, List[float]] = {route: [] for route in routes}
+    errors: Dict[str, int] = {route: 0 for route in routes}
+
+    async def worker():
+        while not jobs.empty():
+            client, route = jobs.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await client.get(route)
+                failed = response.status_code >= 400
+            except Exception as e:
+                logging.warning(f"{route} failed: {e!r}")
+                failed = True
+            timings[route].append(time.perf_counter() - start)
+            errors[route] += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, timings, errors
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    fake = Fake(args)
+    await fake.start()
+    database = Path(tempfile.mkdtemp()) / "bench.sqlite3"
+    os.environ.update(
+        SPOTIFY_API_URL=fake.url,
+        SPOTIFY_ACCOUNTS_URL=fake.url,
+        POSTGRES_URL=f"sqlite://{database}",
+        SHARED_BACKEND_URL="",
+    )
+    for name, value in {
+        "CLIENT_ID": "bench",
+        "CLIENT_SECRET": "bench",
+        "REDIRECT_URI": "http://bench/callback",
+        "SECRET_KEY": "bench",
+        "SECRET_SALT": "bench",
+        "HISTORY_SYNC_MINUTES": "0",
+    }.items():
+        os.environ.setdefault(name, value)
+
+    sys.path.insert(0, str(ROOT))
+    import main
+
+    logging.getLogger().setLevel(args.log_level)
+    fixture = json.loads((ROOT / "bench/fixtures/playlist_tracks.json").read_text())
+    track_id = fixture["items"][0]["track"]["id"]
+    routes = [route.format(track_id=track_id) for route in ROUTES]
+    results: Dict[str, Any] = {"memory": {"start": _memory()}}
+
+    transport = httpx.ASGITransport(app=main.app)
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            probe = await login(transport, "probe")
+            cold = await upstream_calls(fake, probe, routes)
+            warm = await upstream_calls(fake, probe, routes)
+
+            clients = await asyncio.gather(
+                *(login(transport, f"user{i}") for i in range(args.users))
+            )
+            results["memory"]["logged_in"] = _memory()
+            await fake.reset()
+            elapsed, timings, errors = await load(
+                clients, routes, args.rounds, args.concurrency
+            )
+            results["memory"]["end"] = _memory()
+            calls = await fake.calls()
+            for client in [probe, *clients]:
+                await client.aclose()
+    finally:
+        await fake.stop()
+
+    requests = sum(len(t) for t in timings.values())
+    results.update(
+        {
+            "config": {**vars(args), "json": args.json and str(args.json)},
+            "requests": requests,
+            "seconds": elapsed,
+            "rps": requests / elapsed,
+            "upstream_calls": sum(n for name, n in calls.items() if name != "429"),
+            "upstream_429s": calls.get("429", 0),
+            "routes": {
+                route: {
+                    "requests": len(timings[route]),
+                    "errors": errors[route],
+                    "p50": _percentile(timings[route], 50) * 1000,
+                    "p95": _percentile(timings[route], 95) * 1000,
+                    "p99": _percentile(timings[route], 99) * 1000,
+                    "calls_cold": cold[route],
+                    "calls_warm": warm[route],
+                }
+                for route in routes
+            },
+        }
+    )
+    return results
+
+
+def report(results: Dict[str, Any]) -> None:
+    print(
+        f"{results['requests']} requests in {results['seconds']:.2f}s: "
+        f"{results['rps']:.0f} req/s, {results['upstream_calls']} Spotify calls "
+        f"({results['upstream_calls'] / results['requests']:.2f} per request), "
+        f"{results['upstream_429s']} 429s"
+    )
+    print()
+    width = max(len(route) for route in results["routes"])
+    print(
+        f"{'route':<{width}}  {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'errors':>6}  {'calls cold/warm':>15}"
+    )
+    for route, r in results["routes"].items():
+        calls = f"{r['calls_cold']}/{r['calls_warm']}"
+        print(
+            f"{route:<{width}}  {r['p50']:8.1f} {r['p95']:8.1f} {r['p99']:8.1f} "
+            f"{r['errors']:6}  {calls:>15}"
+        )
+    print()
+    for stage, memory in results["memory"].items():
+        print(f"memory {stage}: {memory['rss']:.0f} MiB (peak {memory['peak']:.0f})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=30, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=10, help="milliseconds")
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="fraction of calls to 429"
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,51 @@
-import traceback
+from typing import Any, Dict
 from fastapi import FastAPI, Request, Depends
-from fastapi.responses import RedirectResponse, JSONResponse, FileResponse
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+)
 from starlette.middleware.sessions import SessionMiddleware
 from itsdangerous import URLSafeSerializer
 import time
 import os
 import random
+import secrets
 import base64
 import datetime
+import hashlib
 import asyncio
 import pytz
-import cachetools
 from tortoise import Tortoise
+from tortoise.backends.base.config_generator import expand_db_url
 from dotenv import load_dotenv
 import logging
 
 
-from models import User, dc_dumps
+from models import User, dumps
+from _backend import Backend, create_backend
+import _logging
+import _metrics
+from _assets import Assets
+from _encoding import CompressionMiddleware, etag_matches
+from _history import HistoryIngestor, history_stats
+from _render import Renderer
 from _http import HTTP
+from _scheduler import RefreshScheduler
+from _sessions import SessionTokens
+from _users import UserCache
+from _wrapped import get_wrapped
 
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG)
+_logging.setup(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    levels=os.getenv("LOG_LEVELS", ""),
+    format=os.getenv("LOG_FORMAT", "text"),
+    sample_burst=int(os.getenv("LOG_SAMPLE_BURST", 10)),
+    sample_interval=float(os.getenv("LOG_SAMPLE_INTERVAL", 60)),
+)
 logger = logging.getLogger(__name__)
 
 
@@ -31,9 +53,48 @@ class App(FastAPI):
     client: "Client"
 
 
+class ModelResponse(JSONResponse):
+    """JSON response that can hold the dataclasses from ``models`` directly."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    """A 304 for ``etag`` if the client already has that version."""
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=_validators(etag))
+    return None
+
+
+def etag_response(request: Request, content, etag: str | None = None) -> Response:
+    """``content`` as JSON with an ETag, or a 304 if it hasn't changed.
+
+    Without an explicit ``etag`` the body is hashed, which still saves the
+    client downloading it again.
+    """
+    body = dumps(content)
+    if etag is None:
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+    return not_modified(request, etag) or Response(
+        body, media_type="application/json", headers=_validators(etag)
+    )
+
+
+def _validators(etag: str) -> Dict[str, str]:
+    # Stored by the browser but always revalidated.
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
 class Client:
     app: "App"
     http: HTTP
+    backend: Backend
+    users: UserCache
+    sessions: SessionTokens | None
+    refresher: RefreshScheduler
+    history: HistoryIngestor | None
+    loop_lag: _metrics.LoopLagMonitor
 
     def __init__(
         self, client_id: str, client_secret: str, *, scopes=[], app: App = None
@@ -45,43 +106,84 @@ class Client:
         self.auth_header = f"Basic {base64.b64encode(f'{self.client_id}:{self.client_secret}'.encode()).decode()}"
 
         self.scope = " ".join(scopes)
-        self.states = []
+        self.backend = create_backend(os.getenv("SHARED_BACKEND_URL"))
+        self.users = UserCache(
+            self.backend,
+            max_size=int(os.getenv("USER_CACHE_SIZE", 10_000)),
+            ttl=float(os.getenv("USER_CACHE_TTL", 30)),
+            shared_ttl=float(os.getenv("USER_SHARED_CACHE_TTL", 300)),
+            negative_ttl=float(os.getenv("USER_NEGATIVE_CACHE_TTL", 0)),
+        )
         self.http = HTTP(self)
+        self.refresher = RefreshScheduler(
+            self.http,
+            concurrency=int(os.getenv("REFRESH_CONCURRENCY", 8)),
+            idle_after=float(os.getenv("REFRESH_IDLE_HOURS", 6)) * 60 * 60,
+            boot_jitter=float(os.getenv("REFRESH_BOOT_JITTER", 60)),
+        )
+        history_interval = float(os.getenv("HISTORY_SYNC_MINUTES", 30)) * 60
+        self.history = None
+        if history_interval > 0:
+            self.history = HistoryIngestor(
+                self.http,
+                interval=history_interval,
+                concurrency=int(os.getenv("HISTORY_SYNC_CONCURRENCY", 2)),
+                max_rate=float(os.getenv("HISTORY_MAX_RATE", 2)),
+            )
+        self.loop_lag = _metrics.LoopLagMonitor()
         self.serializer = URLSafeSerializer(
             os.getenv("SECRET_KEY"), salt=os.getenv("SECRET_SALT").encode()
         )
+        self.sessions = None
+        if os.getenv("SESSION_TOKENS", "").lower() in ("1", "true", "yes"):
+            # Older keys first; the last one signs new tokens.
+            keys = os.getenv("SECRET_KEY_FALLBACKS", "").split(",")
+            self.sessions = SessionTokens(
+                [key for key in keys if key] + [os.getenv("SECRET_KEY")],
+                os.getenv("SECRET_SALT"),
+                self.backend,
+                max_age=float(os.getenv("SESSION_MAX_AGE_DAYS", 30)) * 24 * 60 * 60,
+                rotate_after=float(os.getenv("SESSION_ROTATE_HOURS", 24)) * 60 * 60,
+            )
+
+    def db_config(self) -> dict:
+        connection = expand_db_url(
+            os.getenv("POSTGRES_URL") or "sqlite://unwrapped.sqlite3"
+        )
+        if connection["engine"] == "tortoise.backends.asyncpg":
+            # Pool settings in the URL itself win over these.
+            connection["credentials"].setdefault(
+                "minsize", int(os.getenv("DB_POOL_MIN", 2))
+            )
+            connection["credentials"].setdefault(
+                "maxsize", int(os.getenv("DB_POOL_MAX", 20))
+            )
+        return {
+            "connections": {"default": connection},
+            "apps": {
+                "models": {"models": ["models"], "default_connection": "default"}
+            },
+            "use_tz": True,
+        }
 
     async def retry_db_connection(self, retries=3, delay=5):
         for _ in range(retries):
             try:
-                await Tortoise.init(
-                    db_url=os.getenv("POSTGRES_URL"),
-                    modules={"models": ["models"]},
-                    use_tz=True,
-                )
+                await Tortoise.init(config=self.db_config())
                 await Tortoise.generate_schemas()
                 break
             except Exception as e:
-                print(f"DB connection failed: {e}, retrying...")
+                logger.warning(f"DB connection failed: {e}, retrying...")
                 await asyncio.sleep(delay)
 
     async def setup(self):
         await self.retry_db_connection()
+        await self.backend.setup()
         await self.http.setup()
-        uc = 0
-
-        for user in await User.all():
-            uc += 1
-            asyncio.create_task(self.refresh_task(user))
-
-        logger.info(f"Loaded {uc} users")
-
-    async def refresh_task(self, user):
-        now = datetime.datetime.now(pytz.utc)
-        token_expires = user.token_expires.replace(tzinfo=pytz.utc)
-        await asyncio.sleep((token_expires - now).total_seconds())
-        await self.http.refresh_token(user)
-        asyncio.create_task(self.refresh_task(user))
+        self.loop_lag.start()
+        await self.refresher.start()
+        if self.history:
+            await self.history.start()
 
 
 app = App(
@@ -104,29 +206,20 @@ client = Client(
     app=app,
 )
 
-templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-
-@app.get("/static/fonts/{font_name}")
-async def get_font(font_name: str):
-    file_path = f"static/fonts/{font_name}"
-    headers = {"Cache-Control": "public, max-age=31536000"}
-    return FileResponse(file_path, headers=headers)
-
-
-@app.get("/static/logo/{logo_name}")
-async def get_logo(logo_name: str):
-    file_path = f"static/logo/{logo_name}"
-    headers = {"Cache-Control": "public, max-age=1000"}
-    return FileResponse(file_path, headers=headers)
+renderer = Renderer(
+    cache_dir=os.getenv("TEMPLATE_CACHE_DIR"),
+    auto_reload=os.getenv("TEMPLATE_AUTO_RELOAD", "").lower() in ("1", "true", "yes"),
+    inline_first_page=os.getenv("INLINE_FIRST_PAGE", "1").lower()
+    in ("1", "true", "yes"),
+)
+templates = renderer.templates
+assets = Assets("static")
+renderer.env.globals["asset_url"] = assets.url
 
 
-@app.get("/spotify_logo")
-async def get_spotify_logo():
-    file_path = f"static/logo/SpotifyLogo.png"
-    headers = {"Cache-Control": "public, max-age=31536000"}
-    return FileResponse(file_path, headers=headers)
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"])
+async def static(request: Request, path: str):
+    return assets.response(request, path)
 
 
 @app.get("/privacy_policy")
@@ -135,6 +228,30 @@ async def toc(request: Request):
 
 
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SECRET_KEY"))
+app.add_middleware(
+    CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", 500))
+)
+app.add_middleware(_metrics.MetricsMiddleware)
+app.add_middleware(_logging.RequestIdMiddleware)
+
+_metrics.stats(
+    "unwrapped_user_cache", "User cache lookups and size.", client.users.stats
+)
+_metrics.stats(
+    "unwrapped_response_cache", "Spotify response cache.", client.http.cache.stats
+)
+_metrics.stats("unwrapped_catalog", "Shared catalog.", client.http.catalog.stats)
+_metrics.stats(
+    "unwrapped_spotify_limiter", "Spotify rate limiter.", client.http.limiter.stats
+)
+_metrics.stats(
+    "unwrapped_spotify_pool", "Spotify connection pool.", client.http.pool_stats
+)
+_metrics.Gauge(
+    "unwrapped_spotify_queued",
+    "Spotify requests waiting for a slot.",
+    read=lambda: client.http.queued,
+)
 
 
 def sign_data(data):
@@ -145,34 +262,63 @@ def unsign_data(data) -> str:
     return client.serializer.loads(data)
 
 
-user_cache = cachetools.TTLCache(maxsize=100, ttl=30)
+STATE_TTL = 600
 
 
-async def get_cached_user(key: str) -> User:
-    try:
-        return user_cache[key]
-    except KeyError:
-        user = await User.get(key=key)
-        user_cache[key] = user
-        return user
+async def _get_session(request: Request) -> Dict[str, Any] | None:
+    claims = await client.sessions.verify(request.session.get("session"))
+    if claims is None:
+        request.session.pop("session", None)
+    return claims
 
 
 async def _get_user(request: Request) -> User | None:
-    try:
-        key = unsign_data(request.session.get("key"))
-    except:
-        request.session.pop("key", None)
-        return None
-    if not key:
-        return None
-    try:
-        user = await get_cached_user(key)
-    except User.DoesNotExist:
-        return None
+    if client.sessions:
+        claims = await _get_session(request)
+        if claims is None:
+            return None
+        user = await client.users.get_by_id(claims["uid"])
+        if user is None:
+            return None
+        if client.sessions.stale(claims):
+            request.session["session"] = client.sessions.issue(user, claims["sid"])
+    else:
+        try:
+            key = unsign_data(request.session.get("key"))
+        except:
+            request.session.pop("key", None)
+            return None
+        if not key:
+            return None
+        user = await client.users.get(key)
+        if user is None:
+            return None
+    client.refresher.touch(user)
     return user
 
 
+async def _logged_in(request: Request) -> bool:
+    """Like ``get_user`` for pages that don't need the user itself.
+
+    With session tokens this is answered from the cookie alone.
+    """
+    if client.sessions:
+        return await _get_session(request) is not None
+    return await _get_user(request) is not None
+
+
+async def _page_user(request: Request) -> User | bool | None:
+    """The user if the page inlines its first page, else whether there is one.
+
+    Either way the session is resolved once per request.
+    """
+    if renderer.inline_first_page:
+        return await _get_user(request)
+    return await _logged_in(request)
+
+
 get_user = Depends(_get_user)
+page_user = Depends(_page_user)
 
 
 @app.get("/")
@@ -181,12 +327,10 @@ async def root(request: Request, user: User = get_user):
 
 
 @app.get("/favicon.ico")
-async def favicon():
-    file_path = f"static/logo/IconCircle.png"
-    headers = {
-        # "Cache-Control": "public, max-age=31536000"
-    }
-    return FileResponse(file_path, headers=headers)
+async def favicon(request: Request):
+    return assets.response(
+        request, "logo/IconCircle.png", cache_control="public, max-age=86400"
+    )
 
 
 @app.get("/profile")
@@ -196,21 +340,56 @@ async def profile(request: Request, user: User = get_user):
     return templates.TemplateResponse("profile.html", {"request": request, "user": user})
 
 
+def render_page(request: Request, name: str, context: dict, user, load_page=None):
+    """Render a page whose items the browser loads with ``load_more_*``.
+
+    ``user`` comes from ``page_user``. When ``INLINE_FIRST_PAGE`` is on,
+    ``load_page(user)`` runs while the page is sent and its result is
+    inlined as the first page.
+    """
+    first_page = None
+    if load_page is not None and isinstance(user, User):
+        first_page = lambda: load_page(user)
+    return renderer.stream(request, name, context, first_page)
+
+
+async def playlists_page(user: User, page: int) -> dict:
+    playlists = await client.http.get_user_playlists(user, offset=page * 20, limit=20)
+    return {"playlists": playlists}
+
+
+async def playlist_tracks_page(user: User, playlist_id: str, page: int) -> dict:
+    playlist = await client.http.get_playlist(user, playlist_id)
+    tracks = await client.http.playlists.get_page(user, playlist, page * 20, 20)
+    return {"tracks": tracks}
+
+
+async def top_tracks_page(user: User, type: str, page: int) -> dict:
+    tracks = await client.http.get_top_tracks(user, type=type, offset=page * 20)
+    tracks.sort(key=lambda x: x.popularity, reverse=True)
+    return {"tracks": tracks}
+
+
+async def top_artists_page(user: User, type: str, page: int) -> dict:
+    artists = await client.http.get_top_artists(user, type=type, offset=page * 20)
+    artists.sort(key=lambda x: x.popularity, reverse=True)
+    return {"artists": artists}
+
+
 @app.get("/playlists")
-async def playlists(request: Request, user: User = get_user):
+async def playlists(request: Request, user: User | bool = page_user):
     if not user:
         return RedirectResponse("/login")
-    return templates.TemplateResponse("playlists.html", {"request": request})
+    return render_page(
+        request, "playlists.html", {}, user, lambda user: playlists_page(user, 0)
+    )
 
 
 @app.get("/load_more_playlists")
 async def load_more_playlists(request: Request, page: int, user: User = get_user):
-    offset = page * 20
     if not user:
         return RedirectResponse("/login")
-    playlists = await client.http.get_user_playlists(user, offset=offset, limit=20)
-    playlists = [dc_dumps(playlist) for playlist in playlists]
-    return JSONResponse({"playlists": playlists})
+    return etag_response(request, await playlists_page(user, page))
 
 
 @app.get("/playlist")
@@ -218,8 +397,11 @@ async def playlist(request: Request, playlist_id: str, user: User = get_user):
     if not user:
         return RedirectResponse("/login")
     playlist = await client.http.get_playlist(user, playlist_id)
-    return templates.TemplateResponse(
-        "playlist.html", {"request": request, "playlist": playlist}
+    return renderer.stream(
+        request,
+        "playlist.html",
+        {"playlist": playlist},
+        lambda: playlist_tracks_page(user, playlist_id, 0),
     )
 
 
@@ -229,18 +411,31 @@ async def load_more_playlist_tracks(
 ):
     if not user:
         return RedirectResponse("/login")
-    offset = page * 20
-    tracks = await client.http.get_playlist_tracks(user, playlist_id, offset=offset)
-    tracks.sort(key=lambda x: x.added_at, reverse=True)
-    return JSONResponse({"tracks": [dc_dumps(track) for track in tracks]})
+    playlist = await client.http.get_playlist(user, playlist_id)
+    etag = None
+    if playlist.snapshot_id:
+        # A snapshot id names one version of the playlist's tracks.
+        etag = f'"{playlist.id}-{playlist.snapshot_id}-{page}"'
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+    return etag_response(
+        request, await playlist_tracks_page(user, playlist_id, page), etag
+    )
 
 
 @app.get("/toptracks")
-async def top_tracks(request: Request, type: str = "short_term", user: User = get_user):
+async def top_tracks(
+    request: Request, type: str = "short_term", user: User | bool = page_user
+):
     if not user:
         return RedirectResponse("/login")
-    return templates.TemplateResponse(
-        "top_tracks.html", {"request": request, "type": type}
+    return render_page(
+        request,
+        "top_tracks.html",
+        {"type": type},
+        user,
+        lambda user: top_tracks_page(user, type, 0),
     )
 
 
@@ -250,20 +445,21 @@ async def load_more_toptracks(
 ):
     if not user:
         return RedirectResponse("/login")
-    offset = page * 20
-    tracks = await client.http.get_top_tracks(user, type=type, offset=offset)
-    tracks.sort(key=lambda x: x.popularity, reverse=True)
-    return JSONResponse({"tracks": [dc_dumps(track) for track in tracks]})
+    return etag_response(request, await top_tracks_page(user, type, page))
 
 
 @app.get("/topartists")
 async def top_artists(
-    request: Request, type: str = "short_term", user: User = get_user
+    request: Request, type: str = "short_term", user: User | bool = page_user
 ):
     if not user:
         return RedirectResponse("/login")
-    return templates.TemplateResponse(
-        "top_artists.html", {"request": request, "type": type}
+    return render_page(
+        request,
+        "top_artists.html",
+        {"type": type},
+        user,
+        lambda user: top_artists_page(user, type, 0),
     )
 
 
@@ -273,10 +469,35 @@ async def load_more_topartists(
 ):
     if not user:
         return RedirectResponse("/login")
-    offset = page * 20
-    artists = await client.http.get_top_artists(user, type=type, offset=offset)
-    artists.sort(key=lambda x: x.popularity, reverse=True)
-    return JSONResponse({"artists": [dc_dumps(artist) for artist in artists]})
+    return etag_response(request, await top_artists_page(user, type, page))
+
+@app.get("/wrapped")
+async def wrapped(request: Request, user: User = get_user):
+    if not user:
+        return RedirectResponse("/login")
+    stats = await get_wrapped(client.http, user)
+    return templates.TemplateResponse(
+        "wrapped.html", {"request": request, "stats": stats}
+    )
+
+
+@app.get("/history_stats")
+async def get_history_stats(
+    request: Request,
+    days: int = 30,
+    start: datetime.date | None = None,
+    end: datetime.date | None = None,
+    user: User = get_user,
+):
+    if not user:
+        return RedirectResponse("/login")
+    # ``end`` is inclusive here and exclusive in history_stats.
+    end = (end or datetime.datetime.now(pytz.utc).date()) + datetime.timedelta(days=1)
+    start = start or end - datetime.timedelta(days=days)
+    if start >= end:
+        return ModelResponse({"error": "start must not be after end"}, status_code=400)
+    return ModelResponse(await history_stats(user, start, end))
+
 
 @app.get("/track")
 async def track(request: Request, track_id: str, user: User = get_user):
@@ -291,9 +512,9 @@ async def login(
     request: Request,
 ):
     state = str(time.time() * random.random())
-    client.states.append(state)
+    await client.backend.set("state", state, True, STATE_TTL)
     url = (
-        "https://accounts.spotify.com/authorize?"
+        f"{client.http.accounts_url}/authorize?"
         f"client_id={client.client_id}"
         f"&response_type=code"
         f"&redirect_uri={client.redirect_uri}"
@@ -311,33 +532,41 @@ async def callback(
     error: str = None,
 ):
     try:
-        if error:
-            try:
-                client.states.remove(state)
-            except ValueError:
-                return RedirectResponse("/login")
-        if state not in client.states:
+        valid_state = await client.backend.pop("state", state)
+        if error or not valid_state:
             return RedirectResponse("/login")
 
         user_data, token_data = await client.http.get_user_data(code)
         user = await client.http.get_or_create_user(user_data, token_data)
-        user_cache[user.key] = user
-        request.session["key"] = sign_data(user.key)
+        client.refresher.touch(user)
+        if client.sessions:
+            request.session["session"] = client.sessions.issue(user)
+        else:
+            request.session["key"] = sign_data(user.key)
 
         return templates.TemplateResponse(
             "loggedin.html", {"request": request, "user": user}
         )
     except Exception as e:
-        logger.error(f"Error during callback: {e}\n{traceback.format_exc()}")
+        logger.exception(f"Error during callback: {e}")
         if "user may not be registered" in str(e):
             return {
                 "error": "User is not registered as a tester. Please contact the administrator."
             }
-        return {"error": str(e), "traceback": traceback.format_exc()}
+        # Details stay in the log, findable by the request id.
+        return {
+            "error": "Logging in failed, please try again.",
+            "request_id": _logging.request_id.get(),
+        }
 
 
 @app.get("/logout")
 async def logout(request: Request):
+    if client.sessions:
+        claims = await _get_session(request)
+        if claims:
+            await client.sessions.revoke(claims)
+        request.session.pop("session", None)
     request.session.pop("key", None)
     return RedirectResponse("/")
 
@@ -347,17 +576,39 @@ async def ping():
     return
 
 
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    if not METRICS_TOKEN:
+        return Response(status_code=404)
+    authorization = request.headers.get("authorization", "").encode()
+    if not secrets.compare_digest(authorization, f"Bearer {METRICS_TOKEN}".encode()):
+        return Response(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    return PlainTextResponse(
+        _metrics.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 async def startup():
     try:
+        assets.build()
+        renderer.warm()
         await client.setup()
     except Exception as e:
-        print(f"Error during startup: {e}")
+        logger.error(f"Error during startup: {e}")
         raise e
 
 
 async def shutdown():
+    await client.loop_lag.close()
+    await client.refresher.close()
+    if client.history:
+        await client.history.close()
     await Tortoise.close_connections()
     await client.http.close()
+    await client.backend.close()
 
 
 app.add_event_handler("startup", startup)
@@ -1,24 +1,34 @@
 from tortoise import Model, fields
-from dataclasses import dataclass, asdict
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+import datetime
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class DataclassEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if hasattr(obj, "__dataclass_fields__"):
-            return asdict(obj)
-        return super().default(obj)
 
+def _default(obj):
+    if hasattr(obj, "__dataclass_fields__"):
+        # Shallow on purpose: nested dataclasses come back through here, so
+        # nothing gets copied the way dataclasses.asdict would.
+        return {name: getattr(obj, name) for name in obj.__dataclass_fields__}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
-def dc_dumps(obj):
-    return json.dumps(obj, cls=DataclassEncoder)
+
+def dumps(obj) -> bytes:
+    """Serialize ``obj``, including any dataclasses in it, to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode()
 
 
 class User(Model):
     id = fields.BigIntField(pk=True, generated=True)
-    key = fields.CharField(max_length=512, null=True)
-    spotify_id = fields.CharField(max_length=255)
+    key = fields.CharField(max_length=512, null=True, unique=True)
+    spotify_id = fields.CharField(max_length=255, unique=True)
     country = fields.CharField(max_length=255, null=True)
     display_name = fields.CharField(max_length=255, null=True)
     email = fields.CharField(max_length=255, null=True)
@@ -28,17 +38,104 @@ class User(Model):
     product = fields.CharField(max_length=255, null=True)
     access_token = fields.CharField(max_length=512, null=True)
     refresh_token = fields.CharField(max_length=512, null=True)
-    token_expires = fields.DatetimeField(null=True)
+    token_expires = fields.DatetimeField(null=True, index=True)
     created_at = fields.DatetimeField(auto_now_add=True)
 
     def __repr__(self):
         return f"User<{self.spotify_id}>"
 
+    def to_cache(self) -> Dict[str, Any]:
+        """Return the row as JSON-safe values for the shared backend."""
+        data = {}
+        for field, column in self._meta.fields_db_projection.items():
+            value = getattr(self, field)
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            data[column] = value
+        return data
+
+    @classmethod
+    def from_cache(cls, data: Dict[str, Any]) -> "User":
+        return cls._init_from_db(**data)
+
+
+class Play(Model):
+    """One play from a user's recently played history. Append only."""
+
+    id = fields.BigIntField(pk=True, generated=True)
+    user = fields.ForeignKeyField("models.User", related_name="plays")
+    played_at = fields.DatetimeField()
+    track_id = fields.CharField(max_length=32)
+    album_id = fields.CharField(max_length=32, null=True)
+    # Comma separated, primary artist first.
+    artist_ids = fields.CharField(max_length=255)
+    # Spotify doesn't report how much of the track was played, so this is
+    # the track length.
+    ms_played = fields.IntField()
+
+    class Meta:
+        unique_together = (("user", "played_at"),)
+
+    def __repr__(self):
+        return f"Play<{self.user_id} {self.track_id} {self.played_at}>"
+
+
+class PlayRollup(Model):
+    """Plays and listening time per user, item and day or month.
+
+    ``bucket`` is the first day of the period (UTC). Rows are only ever
+    incremented, by ``_rollups.add_plays`` when new plays are stored.
+    """
+
+    id = fields.BigIntField(pk=True, generated=True)
+    user = fields.ForeignKeyField("models.User", related_name="rollups")
+    period = fields.CharField(max_length=5)  # "day" or "month"
+    bucket = fields.DateField()
+    kind = fields.CharField(max_length=6)  # "track", "artist", "album" or "genre"
+    item_id = fields.CharField(max_length=255)
+    plays = fields.IntField(default=0)
+    ms_played = fields.BigIntField(default=0)
+
+    class Meta:
+        unique_together = (("user", "period", "kind", "bucket", "item_id"),)
+
+    def __repr__(self):
+        return f"PlayRollup<{self.user_id} {self.period} {self.bucket} {self.kind}>"
+
+
+class CatalogItem(Model):
+    """A Spotify track or artist as returned by the API, shared by all users."""
+
+    id = fields.BigIntField(pk=True, generated=True)
+    kind = fields.CharField(max_length=6)  # "track" or "artist"
+    spotify_id = fields.CharField(max_length=32)
+    data = fields.TextField()
+    updated_at = fields.DatetimeField()
+
+    class Meta:
+        unique_together = (("kind", "spotify_id"),)
+
+    def __repr__(self):
+        return f"CatalogItem<{self.kind} {self.spotify_id}>"
+
 
 # Dataclasses so we won't store the user's personal data :)
+#
+# Slotted to keep per-object memory down; every Spotify payload is mapped
+# through the from_json constructors below, which only read the fields we keep.
+
 
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-@dataclass
+
+def _image(images: List[Dict[str, Any]] | None) -> str | None:
+    return images[0]["url"] if images else None
+
+
+@dataclass(slots=True)
 class Playlist:
     id: str
     name: str
@@ -54,8 +151,25 @@ class Playlist:
     image: str | None = None
     tracks: List[str] | None = None
 
-
-@dataclass
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Playlist":
+        return cls(
+            id=data["id"],
+            name=data["name"],
+            collaborative=data["collaborative"],
+            description=data["description"],
+            href=data["href"],
+            image=_image(data["images"]),
+            owner_id=data["owner"]["id"],
+            owner_name=data["owner"]["display_name"],
+            public=data["public"],
+            snapshot_id=data["snapshot_id"],
+            track_href=data["tracks"]["href"],
+            track_count=data["tracks"]["total"],
+        )
+
+
+@dataclass(slots=True)
 class Artist:
     id: str
     name: str
@@ -65,8 +179,22 @@ class Artist:
     followers: int | None = None
     genres: List[str] | None = None
 
-
-@dataclass
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Artist":
+        """Map a full or simplified artist object."""
+        followers = data.get("followers")
+        return cls(
+            id=data["id"],
+            name=data["name"],
+            uri=data["uri"],
+            image=_image(data.get("images")),
+            popularity=data.get("popularity"),
+            followers=followers["total"] if followers else None,
+            genres=data.get("genres"),
+        )
+
+
+@dataclass(slots=True)
 class Album:
     id: str
     uri: str
@@ -74,8 +202,18 @@ class Album:
     artists: List[Artist] | None = None
     image: str | None = None
 
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Album":
+        return cls(
+            id=data["id"],
+            name=data["name"],
+            artists=[Artist.from_json(artist) for artist in data["artists"]],
+            image=_image(data.get("images")),
+            uri=data["uri"],
+        )
+
 
-@dataclass
+@dataclass(slots=True)
 class Track:
     id: str
     name: str
@@ -87,8 +225,31 @@ class Track:
     uri: str
     preview_url: str | None = None
 
-
-@dataclass
+    @classmethod
+    def from_json(cls, data: Dict[str, Any], **extra: Any) -> "Track":
+        return cls(
+            id=data["id"],
+            name=data["name"],
+            artists=[Artist.from_json(artist) for artist in data["artists"]],
+            album=Album.from_json(data["album"]),
+            duration_ms=data["duration_ms"],
+            popularity=data["popularity"],
+            explicit=data["explicit"],
+            uri=data["uri"],
+            **extra,
+        )
+
+
+@dataclass(slots=True)
 class PlaylistTrack(Track):
     added_at: str | None = None
     added_by: str | None = None
+
+    @classmethod
+    def from_item(cls, item: Dict[str, Any]) -> "PlaylistTrack":
+        """Map an item of a playlist's track list."""
+        return cls.from_json(
+            item["track"],
+            added_at=item["added_at"],
+            added_by=(item["added_by"] or {}).get("id"),
+        )
@@ -10,6 +10,7 @@ document.addEventListener("DOMContentLoaded", function() {
             <div id="navButtons">
                 <button id="topArtistsButton" onclick="window.location.href='/topartists'">Top Artists</button>
                 <button id="topTracksButton" onclick="window.location.href='/toptracks'">Top Tracks</button>
+                <button id="wrappedButton" onclick="window.location.href='/wrapped'">Wrapped</button>
                 <!-- <button id="playlistsButton" onclick="window.location.href='/playlists'">Playlists</button> -->
                 <div id="profileButtonContainer">
                     <button id="profileButton" style="display:none;">